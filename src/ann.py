@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import numpy as np
+from mining import knn, merge_topk, sort_topk, read_lines
+
+
+class options():
+
+    def __init__(self, argv):
+        self.index = None
+        self.build = None
+        self.search = None
+        self.bench = None
+        self.nlist = 0
+        self.niter = 10
+        self.train_size = 100000
+        self.fp16 = False
+        self.k = 4
+        self.nprobe = [8]
+        self.nqueries = 1000
+        self.block = 1024
+        self.src_txt = None
+        self.tgt_txt = None
+        self.pairs = None
+        self.output = '-'
+        self.seed = 1234
+        usage = """usage: {}
+*  -index       PREFIX : index files (PREFIX.centroids.npy, PREFIX.vectors.npy, PREFIX.ids.npy, PREFIX.offs.npy)
+   -build         FILE : build the index of these sentence vectors (.npy written by similarity.py -encode)
+   -search        FILE : search the k nearest neighbours of these sentence vectors (.npy) in the index
+   -bench         FILE : compare recall and speed of the index with exact search for the first -nqueries vectors of
+                         this file (.npy), for every value of -nprobe
+
+ [BUILD OPTIONS]
+   -nlist          INT : number of lists (k-means centroids), at most -train_size (k-means needs about 40 vectors
+                         per centroid) [4*sqrt(number of vectors)]
+   -niter          INT : k-means iterations [10]
+   -train_size     INT : k-means is trained over this many vectors (randomly sampled) [100000]
+   -fp16               : indexed vectors are stored as float16 (float32 otherwise)
+   -seed           INT : seed for randomness [1234]
+
+ [SEARCH/BENCH OPTIONS]
+   -k              INT : number of nearest neighbours [4]
+   -nprobe        LIST : number of lists (nearest centroids) searched for every query, comma-separated values for
+                         -bench [8]
+   -nqueries       INT : number of queries used by -bench [1000]
+   -block          INT : queries are searched by blocks of this many vectors [1024]
+   -src_txt       FILE : sentences of the -search vectors, output with neighbours
+   -tgt_txt       FILE : sentences of the indexed vectors, output with neighbours
+   -pairs         FILE : write candidate pairs (src sentence tab tgt sentence) into this file, they can be rescored
+                         with the alignment model: similarity.py -mdir DIR -tst FILE (needs -src_txt and -tgt_txt)
+   -output        FILE : output file [- by default is STDOUT]
+   -h                  : this help
+
+- Inverted file index (IVF): vectors are grouped by their nearest centroid (spherical k-means over normalized
+  vectors), a query is only compared with the vectors of its -nprobe nearest lists (cosine similarity).
+- -search outputs a line per neighbour: score, query line, indexed line (numbered from 1), and sentences if given.
+""".format(argv.pop(0))
+
+        while len(argv):
+            tok = argv.pop(0)
+            if (tok == "-index" and len(argv)):
+                self.index = argv.pop(0)
+            elif (tok == "-build" and len(argv)):
+                self.build = argv.pop(0)
+            elif (tok == "-search" and len(argv)):
+                self.search = argv.pop(0)
+            elif (tok == "-bench" and len(argv)):
+                self.bench = argv.pop(0)
+            elif (tok == "-nlist" and len(argv)):
+                self.nlist = int(argv.pop(0))
+            elif (tok == "-niter" and len(argv)):
+                self.niter = int(argv.pop(0))
+            elif (tok == "-train_size" and len(argv)):
+                self.train_size = int(argv.pop(0))
+            elif (tok == "-fp16"):
+                self.fp16 = True
+            elif (tok == "-seed" and len(argv)):
+                self.seed = int(argv.pop(0))
+            elif (tok == "-k" and len(argv)):
+                self.k = int(argv.pop(0))
+            elif (tok == "-nprobe" and len(argv)):
+                self.nprobe = map(int, argv.pop(0).split(','))
+            elif (tok == "-nqueries" and len(argv)):
+                self.nqueries = int(argv.pop(0))
+            elif (tok == "-block" and len(argv)):
+                self.block = int(argv.pop(0))
+            elif (tok == "-src_txt" and len(argv)):
+                self.src_txt = argv.pop(0)
+            elif (tok == "-tgt_txt" and len(argv)):
+                self.tgt_txt = argv.pop(0)
+            elif (tok == "-pairs" and len(argv)):
+                self.pairs = argv.pop(0)
+            elif (tok == "-output" and len(argv)):
+                self.output = argv.pop(0)
+            elif (tok == "-h"):
+                sys.stderr.write("{}".format(usage))
+                sys.exit()
+            else:
+                sys.stderr.write('error: unparsed {} option\n'.format(tok))
+                sys.stderr.write("{}".format(usage))
+                sys.exit(1)
+
+        if self.index is None or (self.build is None and self.search is None and self.bench is None):
+            sys.stderr.write('error: missing -index or -build/-search/-bench option\n{}'.format(usage))
+            sys.exit(1)
+        if self.pairs is not None and (self.src_txt is None or self.tgt_txt is None):
+            sys.stderr.write('error: -pairs needs -src_txt and -tgt_txt\n')
+            sys.exit(1)
+
+
+def normalized(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.sqrt(np.maximum(np.sum(x * x, axis=1, keepdims=True), 1e-12))
+
+
+def assign(x, centroids, block=4096):
+    """nearest centroid (cosine) of every row of x"""
+    lists = np.zeros(len(x), dtype=np.int64)
+    for i in range(0, len(x), block):
+        lists[i:i+block] = np.argmax(np.dot(normalized(x[i:i+block]), centroids.T), axis=1)
+    return lists
+
+
+def kmeans(x, nlist, niter, block=4096):
+    """spherical k-means (normalized centroids) of the rows of x (normalized), empty clusters are re-initialized
+    with random rows of x"""
+    centroids = x[np.random.choice(len(x), nlist, replace=False)]
+    for it in range(niter):
+        lists = assign(x, centroids, block)
+        order = np.argsort(lists, kind='mergesort')
+        counts = np.bincount(lists, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        nonempty = counts > 0
+        ### sums of the rows of each (non-empty) cluster
+        sums[nonempty] = np.add.reduceat(x[order], np.cumsum(counts)[nonempty] - counts[nonempty], axis=0)
+        sums[~nonempty] = x[np.random.choice(len(x), int(np.sum(~nonempty)))]
+        centroids = normalized(sums)
+    return centroids
+
+
+def build_index(x, prefix, nlist=0, niter=10, train_size=100000, fp16=False, block=4096):
+    """writes the index of the rows of x (may be memory-mapped): centroids, normalized vectors ordered by list,
+    their row in x (ids) and the offsets of lists (vectors of list l are vectors[offs[l]:offs[l+1]])"""
+    if nlist <= 0:
+        nlist = int(4 * np.sqrt(len(x)))
+    sample = np.sort(np.random.choice(len(x), min(train_size, len(x)), replace=False))
+    ### centroids are initialized with distinct sampled vectors
+    nlist = max(1, min(nlist, len(sample)))
+    if len(sample) < 39 * nlist:
+        sys.stderr.write('warning: k-means trained over {} vectors for {} lists ({:.1f} per centroid), use a larger '
+                         '-train_size or a smaller -nlist\n'.format(len(sample), nlist, 1.0 * len(sample) / nlist))
+    centroids = kmeans(normalized(x[sample]), nlist, niter, block)
+    lists = assign(x, centroids, block)
+    ids = np.argsort(lists, kind='mergesort')
+    offs = np.zeros(nlist+1, dtype=np.int64)
+    offs[1:] = np.cumsum(np.bincount(lists, minlength=nlist))
+    vectors = np.lib.format.open_memmap(prefix + '.vectors.npy', mode='w+', dtype=np.float16 if fp16 else np.float32,
+                                        shape=(len(x), x.shape[1]))
+    for i in range(0, len(ids), block):
+        vectors[i:i+block] = normalized(x[ids[i:i+block]])
+    vectors.flush()
+    del vectors
+    np.save(prefix + '.centroids.npy', centroids)
+    np.save(prefix + '.ids.npy', ids)
+    np.save(prefix + '.offs.npy', offs)
+    return nlist
+
+
+class IVFIndex():
+    """inverted file index written by build_index (memory-mapped)"""
+
+    def __init__(self, prefix):
+        self.centroids = np.load(prefix + '.centroids.npy')
+        self.vectors = np.load(prefix + '.vectors.npy', mmap_mode='r')
+        self.ids = np.load(prefix + '.ids.npy', mmap_mode='r')
+        self.offs = np.load(prefix + '.offs.npy')
+        self.nlist = len(self.centroids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k, nprobe, block=1024):
+        """approximate k nearest neighbours (cosine) of every query: scores and ids (rows of the indexed vectors)
+        by decreasing score, ids are -1 when less than k vectors are found in the probed lists"""
+        nprobe = min(nprobe, self.nlist)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for i in range(0, len(queries), block):
+            q = normalized(queries[i:i+block])
+            sims = np.dot(q, self.centroids.T)
+            probe = np.argpartition(-sims, nprobe-1, axis=1)[:, :nprobe] if nprobe < self.nlist else \
+                np.tile(np.arange(self.nlist), (len(q), 1))
+            ### (query, list) pairs grouped by list: every list is compared with all its queries at once
+            rows = np.repeat(np.arange(len(q)), nprobe)
+            lists = probe.ravel()
+            order = np.argsort(lists, kind='mergesort')
+            rows, lists = rows[order], lists[order]
+            starts = np.flatnonzero(np.r_[True, lists[1:] != lists[:-1]])
+            ends = np.r_[starts[1:], len(lists)]
+            best_s = np.full((len(q), k), -np.inf, dtype=np.float32)
+            best_i = np.full((len(q), k), -1, dtype=np.int64)
+            for ini, end in zip(starts, ends):
+                lst = lists[ini]
+                if self.offs[lst] == self.offs[lst+1]:
+                    continue
+                r = rows[ini:end]
+                vecs = np.asarray(self.vectors[self.offs[lst]:self.offs[lst+1]], dtype=np.float32)
+                vids = np.broadcast_to(self.ids[self.offs[lst]:self.offs[lst+1]], (len(r), len(vecs)))
+                best_s[r], best_i[r] = merge_topk(best_s[r], best_i[r], np.dot(q[r], vecs.T), vids, k)
+            scores[i:i+len(q)], ids[i:i+len(q)] = sort_topk(best_s, best_i)
+        return scores, ids
+
+
+def bench(index, queries, k, nprobes, nqueries, block):
+    """recall@k of the index with respect to exact search, and queries/s"""
+    queries = np.asarray(queries[:nqueries], dtype=np.float32)
+    ini = time.time()
+    _, exact = knn(queries, index.vectors, k, block)
+    exact_secs = time.time() - ini
+    exact = np.asarray(index.ids)[exact]
+    print("nprobe\trecall@{}\tqueries/s\tspeedup".format(k))
+    print("exact\t1.0000\t{:.1f}\t1.0".format(len(queries) / max(exact_secs, 1e-6)))
+    for nprobe in nprobes:
+        ini = time.time()
+        _, ids = index.search(queries, k, nprobe, block)
+        secs = time.time() - ini
+        found = sum(len(np.intersect1d(ids[q], exact[q])) for q in range(len(queries)))
+        print("{}\t{:.4f}\t{:.1f}\t{:.1f}".format(nprobe, 1.0 * found / exact.size, len(queries) / max(secs, 1e-6),
+                                                  exact_secs / max(secs, 1e-6)))
+        sys.stdout.flush()
+
+
+def load_queries(file, index):
+    queries = np.load(file, mmap_mode='r')
+    if queries.shape[1] != index.centroids.shape[1]:
+        sys.stderr.write('error: vectors of {} and of the index have different sizes ({} and {})\n'.format(
+            file, queries.shape[1], index.centroids.shape[1]))
+        sys.exit(1)
+    return queries
+
+
+def main(args):
+    o = options(args)
+    np.random.seed(o.seed)
+    if o.build is not None:
+        x = np.load(o.build, mmap_mode='r')
+        ini = time.time()
+        nlist = build_index(x, o.index, o.nlist, o.niter, o.train_size, o.fp16)
+        sys.stderr.write('BUILD vectors={} nlist={} time(s)={:.2f}\n'.format(len(x), nlist, time.time() - ini))
+
+    if o.bench is not None:
+        index = IVFIndex(o.index)
+        bench(index, load_queries(o.bench, index), o.k, o.nprobe, o.nqueries, o.block)
+
+    if o.search is not None:
+        index = IVFIndex(o.index)
+        queries = load_queries(o.search, index)
+        src_txt = read_lines(o.src_txt)
+        tgt_txt = read_lines(o.tgt_txt)
+        ini = time.time()
+        scores, ids = index.search(queries, o.k, o.nprobe[0], o.block)
+        secs = time.time() - ini
+        output = sys.stdout if o.output == '-' else open(o.output, 'wb')
+        pairs = open(o.pairs, 'wb') if o.pairs is not None else None
+        for q in range(len(queries)):
+            for score, id in zip(scores[q], ids[q]):
+                if id < 0:
+                    continue
+                line = ["{:.4f}".format(score), str(q+1), str(id+1)]
+                if src_txt is not None:
+                    line.append(src_txt[q])
+                if tgt_txt is not None:
+                    line.append(tgt_txt[id])
+                output.write("\t".join(line) + "\n")
+                if pairs is not None:
+                    pairs.write("{}\t{}\n".format(src_txt[q], tgt_txt[id]))
+        if output is not sys.stdout:
+            output.close()
+        if pairs is not None:
+            pairs.close()
+        sys.stderr.write('SEARCH queries={} k={} nprobe={} time(s)={:.2f} queries/s={:.1f}\n'.format(
+            len(queries), o.k, o.nprobe[0], secs, len(queries) / max(secs, 1e-6)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
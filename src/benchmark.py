@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import json
+import time
+import subprocess
+import tempfile
+
+
+class options():
+
+    def __init__(self, argv):
+        self.mdir = None
+        self.tst = None
+        self.threads = ['0:0']
+        self.procs = [1]
+        self.xla = False
+        self.args = []
+        usage = """usage: {}
+*  -mdir          FILE : model directory
+*  -tst           FILE : test data
+   -threads       LIST : comma-separated intra:inter thread counts, 0 for tensorflow default [0:0]
+   -procs         LIST : comma-separated numbers of co-located processes (each one with -procs N:I) [1]
+   -xla                : run every setting also with -xla
+   -args        STRING : other options of similarity.py (ex: "-batch_size 64 -q")
+   -h                  : this help
+
+- Every setting runs inference of -tst with similarity.py, throughput is read from the -stats records (model loading
+  is not included). With N co-located processes, pairs/s and tok/s are the sum over the N processes.
+""".format(argv.pop(0))
+
+        while len(argv):
+            tok = argv.pop(0)
+            if (tok == "-mdir" and len(argv)):
+                self.mdir = argv.pop(0)
+            elif (tok == "-tst" and len(argv)):
+                self.tst = argv.pop(0)
+            elif (tok == "-threads" and len(argv)):
+                self.threads = argv.pop(0).split(',')
+            elif (tok == "-procs" and len(argv)):
+                self.procs = map(int, argv.pop(0).split(','))
+            elif (tok == "-xla"):
+                self.xla = True
+            elif (tok == "-args" and len(argv)):
+                self.args = argv.pop(0).split()
+            elif (tok == "-h"):
+                sys.stderr.write("{}".format(usage))
+                sys.exit()
+            else:
+                sys.stderr.write('error: unparsed {} option\n'.format(tok))
+                sys.stderr.write("{}".format(usage))
+                sys.exit(1)
+
+        if self.mdir is None or self.tst is None:
+            sys.stderr.write('error: missing -mdir or -tst option\n{}'.format(usage))
+            sys.exit(1)
+
+
+def run_setting(o, nprocs, intra, inter, xla):
+    """runs nprocs inference processes at the same time, returns their test records"""
+    similarity = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'similarity.py')
+    procs = []
+    for i in range(nprocs):
+        ### files are created here (similarity.py appends records to -stats)
+        fd, stats = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        fd, logfile = tempfile.mkstemp(suffix='.log')
+        cmd = [sys.executable, similarity, '-mdir', o.mdir, '-tst', o.tst, '-output', os.devnull, '-stats', stats,
+               '-intra_threads', intra, '-inter_threads', inter] + o.args
+        if nprocs > 1:
+            cmd += ['-procs', '{}:{}'.format(nprocs, i)]
+        if xla:
+            cmd.append('-xla')
+        log = os.fdopen(fd, 'w')
+        procs.append((subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), stats, log, logfile))
+    records = []
+    for p, stats, log, logfile in procs:
+        p.wait()
+        log.close()
+        if p.returncode != 0:
+            sys.stderr.write('error: similarity.py failed, see {}\n'.format(logfile))
+            sys.exit(1)
+        with open(stats) as f:
+            records.append([json.loads(line) for line in f][-1])
+        os.remove(stats)
+        os.remove(logfile)
+    return records
+
+
+def main(args):
+    o = options(args)
+    print("procs\tintra\tinter\txla\tpairs/s\ttok/s(src)\ttok/s(tgt)\tsecs")
+    for nprocs in o.procs:
+        for threads in o.threads:
+            intra, inter = threads.split(':')
+            for xla in ([False, True] if o.xla else [False]):
+                t0 = time.time()
+                totals = [r['total'] for r in run_setting(o, nprocs, intra, inter, xla)]
+                print("{}\t{}\t{}\t{}\t{:.1f}\t{:.1f}\t{:.1f}\t{:.1f}".format(
+                    nprocs, intra, inter, 'yes' if xla else 'no', sum(t['pairs_per_sec'] for t in totals),
+                    sum(t['src_tokens_per_sec'] for t in totals), sum(t['tgt_tokens_per_sec'] for t in totals),
+                    time.time() - t0))
+                sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
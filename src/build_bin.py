@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import json
+import time
+from dataset import Dataset, Vocab, check_dataset, compile_dataset
+
+
+class options():
+
+    def __init__(self, argv):
+        self.data = None
+        self.output = None
+        self.src_voc = None
+        self.tgt_voc = None
+        self.src_tok = None
+        self.tgt_tok = None
+        self.keep_empty = False
+        self.tok_workers = 1
+        usage = """usage: {}
+*  -data          FILE : data to compile (same formats than -trn/-dev/-tst of similarity.py)
+*  -output      PREFIX : prefix of the binary corpus files
+   -src_tok       FILE : if provided, json tokenization options for onmt tokenization, points to vocabulary file
+   -src_voc       FILE : vocabulary of src words
+   -tgt_tok       FILE : if provided, json tokenization options for onmt tokenization, points to vocabulary file
+   -tgt_voc       FILE : vocabulary of tgt words
+   -tok_workers    INT : number of processes used to tokenize data when tokenization options are used [1]
+   -keep_empty         : keep bad entries (as done for -tst) instead of skipping them (as done for -trn/-dev)
+   -h                  : this help
+
+- Options marked with * must be set. The other ones have default values.
+- Vocabularies and tokenization must be the same than those of the model using the binary corpus.
+- Sentences are not filtered by length, -seq_size is applied when the binary corpus is used.
+""".format(argv.pop(0))
+
+        while len(argv):
+            tok = argv.pop(0)
+            if (tok == "-data" and len(argv)):
+                self.data = argv.pop(0)
+            elif (tok == "-output" and len(argv)):
+                self.output = argv.pop(0)
+            elif (tok == "-src_voc" and len(argv)):
+                self.src_voc = argv.pop(0)
+            elif (tok == "-tgt_voc" and len(argv)):
+                self.tgt_voc = argv.pop(0)
+            elif (tok == "-src_tok" and len(argv)):
+                self.src_tok = argv.pop(0)
+            elif (tok == "-tgt_tok" and len(argv)):
+                self.tgt_tok = argv.pop(0)
+            elif (tok == "-tok_workers" and len(argv)):
+                self.tok_workers = int(argv.pop(0))
+            elif (tok == "-keep_empty"):
+                self.keep_empty = True
+            elif (tok == "-h"):
+                sys.stderr.write("{}".format(usage))
+                sys.exit()
+            else:
+                sys.stderr.write('error: unparsed {} option\n'.format(tok))
+                sys.stderr.write("{}".format(usage))
+                sys.exit(1)
+
+        if self.data is None or self.output is None:
+            sys.stderr.write('error: missing -data or -output option\n{}'.format(usage))
+            sys.exit(1)
+
+        self.tok_src = self.read_tok(self.src_tok)
+        if self.tok_src and not self.src_voc:
+            self.src_voc = self.tok_src["vocabulary"]
+        self.tok_tgt = self.read_tok(self.tgt_tok)
+        if self.tok_tgt and not self.tgt_voc:
+            self.tgt_voc = self.tok_tgt["vocabulary"]
+        if self.src_voc is None or self.tgt_voc is None:
+            sys.stderr.write('error: missing -src_voc or -tgt_voc option\n{}'.format(usage))
+            sys.exit(1)
+
+    def read_tok(self, file):
+        if file is None:
+            return None
+        if not os.path.exists(file):
+            sys.stderr.write('error: cannot find tokenization file: {}\n'.format(file))
+            sys.exit(1)
+        with open(file) as jsonfile:
+            return json.load(jsonfile)
+
+
+def main(args):
+    o = options(args)
+    check_dataset(o.data)
+    t0 = time.time()
+    voc_src = Vocab(o.src_voc)
+    voc_tgt = Vocab(o.tgt_voc)
+    data = Dataset(o.data, voc_src, o.tok_src, voc_tgt, o.tok_tgt, seq_size=0, max_sents=0, do_shuffle=False,
+                   do_skip_empty=not o.keep_empty, tok_workers=o.tok_workers)
+    compile_dataset(data, o.output)
+    sys.stderr.write('time: {:.3f} s\n'.format(time.time()-t0))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
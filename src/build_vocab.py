@@ -1,7 +1,9 @@
 #!/usr/bin/python -u
 
 import sys
+import numpy as np
 from collections import defaultdict
+from dataset import str_unk, str_pad
 
 def main(args):
     Freq = defaultdict(int)
@@ -17,8 +19,10 @@ def main(args):
             nwords += 1
             Freq[word] += 1
 
+    ### an output file ending in .npy is written as a binary vocab (memory-mapped when used)
+    binary = len(args) >= 3 and args[2].endswith(".npy")
     output = sys.stdout
-    if len(args) >= 3:
+    if len(args) >= 3 and not binary:
         output = open(args[2],"w")
     sys.stderr.write("#lines={} #words={} vocab={}\n".format(nlines, nwords, len(Freq)))
 
@@ -28,11 +32,20 @@ def main(args):
         sys.stderr.write("Top %s token will be kept.\n" % max_vocab)
 
     i = 0
+    words = []
     for wrd, frq in sorted(Freq.items(), key=lambda(k, v): v, reverse=True):
         i += 1
         if max_vocab is not None and i > max_vocab:
             break
-        output.write("{}\n".format(wrd))
+        if binary:
+            words.append(wrd)
+        else:
+            output.write("{}\n".format(wrd))
+    if binary:
+        toks = np.array([str_unk, str_pad] + words, dtype=np.string_)
+        ### entries are as wide as the longest token
+        sys.stderr.write("binary vocab: {} bytes per entry ({:.1f}MB)\n".format(toks.dtype.itemsize, toks.nbytes / 1e6))
+        np.save(args[2], toks)
 
     if input is not sys.stdin:
         input.close()
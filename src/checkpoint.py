@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import struct
+import numpy as np
+
+### tensorflow DataType enum => numpy type (little-endian)
+dtypes = {1: '<f4', 2: '<f8', 3: '<i4', 4: '<u1', 5: '<i2', 6: '<i1', 9: '<i8', 10: '?', 19: '<f2'}
+### last 8 bytes of a table file
+table_magic = 0xdb4775248b80fb57
+
+
+def varint(buf, pos):
+    """(value, next position) of the varint starting at buf[pos] (buf is a bytearray)"""
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def proto_fields(buf):
+    """(field number, value) of a serialized protocol buffer message: ints for varint/fixed fields, bytearrays for
+    length-delimited ones (strings or sub-messages)"""
+    buf = bytearray(buf)
+    pos = 0
+    while pos < len(buf):
+        key, pos = varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = varint(buf, pos)
+        elif wire == 1:
+            value = struct.unpack('<Q', bytes(buf[pos:pos+8]))[0]
+            pos += 8
+        elif wire == 2:
+            size, pos = varint(buf, pos)
+            value = buf[pos:pos+size]
+            pos += size
+        elif wire == 5:
+            value = struct.unpack('<I', bytes(buf[pos:pos+4]))[0]
+            pos += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(wire))
+        yield key >> 3, value
+
+
+def block_entries(block):
+    """(key, value) entries of a table block: prefix-compressed keys followed by the array of restart points"""
+    block = bytearray(block)
+    nrestarts = struct.unpack('<I', bytes(block[-4:]))[0]
+    end = len(block) - 4 - 4*nrestarts
+    pos = 0
+    key = bytearray()
+    while pos < end:
+        shared, pos = varint(block, pos)
+        non_shared, pos = varint(block, pos)
+        size, pos = varint(block, pos)
+        key = key[:shared] + block[pos:pos+non_shared]
+        pos += non_shared
+        yield bytes(key), bytes(block[pos:pos+size])
+        pos += size
+
+
+class Checkpoint():
+    """reads the variables of a tensorflow checkpoint (mdir/epochN.index and mdir/epochN.data-*) without tensorflow:
+    the index is a table (leveldb format) of tensor names => BundleEntryProto (dtype, shape, shard, offset, size),
+    tensors are raw little-endian arrays in data shards"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.entries = {}
+        with open(prefix + '.index', 'rb') as f:
+            index = f.read()
+        if struct.unpack('<Q', index[-8:])[0] != table_magic:
+            sys.stderr.write('error: {}.index is not a checkpoint index\n'.format(prefix))
+            sys.exit(1)
+        footer = bytearray(index[-48:])
+        _, pos = varint(footer, 0)
+        _, pos = varint(footer, pos)
+        offset, pos = varint(footer, pos)
+        size, pos = varint(footer, pos)
+        self.nshards = 1
+        for _, handle in block_entries(self.block(index, offset, size)):
+            offset, pos = varint(bytearray(handle), 0)
+            size, pos = varint(bytearray(handle), pos)
+            for name, entry in block_entries(self.block(index, offset, size)):
+                if name == b'':
+                    ### header (BundleHeaderProto)
+                    self.nshards = dict(proto_fields(entry)).get(1, 1)
+                else:
+                    self.entries[name.decode('utf-8')] = entry
+
+    def block(self, index, offset, size):
+        ### a block is followed by its compression type (1 byte) and crc (4 bytes)
+        if bytearray(index[offset+size:offset+size+1])[0] != 0:
+            sys.stderr.write('error: compressed blocks in {}.index are not supported\n'.format(self.prefix))
+            sys.exit(1)
+        return index[offset:offset+size]
+
+    def names(self):
+        return sorted(self.entries.keys())
+
+    def tensor(self, name):
+        """numpy array of variable name"""
+        if name not in self.entries:
+            sys.stderr.write('error: variable {} not found in checkpoint {}\n'.format(name, self.prefix))
+            sys.exit(1)
+        dtype = 1
+        shape = []
+        shard = 0
+        offset = 0
+        size = 0
+        for field, value in proto_fields(self.entries[name]):
+            if field == 1:
+                dtype = value
+            elif field == 2:
+                ### TensorShapeProto: repeated dim (field 2) with size (field 1)
+                shape = [dict(proto_fields(dim)).get(1, 0) for num, dim in proto_fields(value) if num == 2]
+            elif field == 3:
+                shard = value
+            elif field == 4:
+                offset = value
+            elif field == 5:
+                size = value
+            elif field == 7:
+                sys.stderr.write('error: partitioned variable {} is not supported\n'.format(name))
+                sys.exit(1)
+        if dtype not in dtypes:
+            sys.stderr.write('error: variable {} has unsupported type {}\n'.format(name, dtype))
+            sys.exit(1)
+        with open('{}.data-{:05d}-of-{:05d}'.format(self.prefix, shard, self.nshards), 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+        return np.frombuffer(data, dtype=dtypes[dtype]).reshape(shape)
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import tensorflow as tf
 import numpy as np
 import io
 import os
@@ -8,6 +7,8 @@ import sys
 import json
 from shutil import copyfile
 from dataset import Vocab, Embeddings, check_dataset
+from monitor import parse_steps
+from server import parse_address
 
 
 class Config():
@@ -18,7 +19,25 @@ class Config():
 
    -seq_size       INT : sentences larger than this number of src/tgt words are filtered out [50]
    -batch_size     INT : number of examples per batch [32]
+   -batch_tokens   INT : batches are sized by this number of padded cells B*(S+T), plus B*S*T in alignment mode,
+                         instead of -batch_size examples (0 to use -batch_size) [0]
+   -prefetch       INT : number of batches built ahead by a background thread (0 for none) [0]
+   -async_score        : accumulate scores (A, P, R, F) in a background thread
    -seed           INT : seed for randomness [1234]
+   -intra_threads  INT : threads used to run a single op (0 for tensorflow default: one per core) [0]
+   -inter_threads  INT : threads used to run independent ops in parallel (0 for tensorflow default) [0]
+   -procs          N:I : this is process I (from 0) out of N processes running on the same host: it is pinned to
+                         its own share of cpus and uses as many intra op threads (unless -intra_threads) [none]
+   -xla                : compile alignment and aggregation ops with XLA (mode must be alignment), ops are
+                         compiled for every new batch shape
+   -cache          DIR : cache tokenized and vocab-mapped data (-trn, -dev, -tst) as binary corpora in this directory,
+                         they are reused while data, tokenization options and vocabularies are unchanged (and
+                         vocab-filtered -src_emb/-tgt_emb embeddings, not cached without -cache)
+   -encode_once        : keep in memory data examples encoded (flat arrays of ids/tags) after the first epoch,
+                         next epochs do not parse text lines again (not used with -shuffle_buffer)
+   -stats         FILE : append metrics (loss, A/P/R/F, lr), timings of each stage (batch, feed, run, score, output,
+                         save), throughput and memory usage to this file as json lines (one per report, epoch,
+                         checkpoint save and test set) [mdir/metrics.jsonl when learning]
    -debug              : debug mode
    -h                  : this message
 
@@ -30,6 +49,7 @@ class Config():
    -src_voc       FILE : vocabulary of src words (needed to initialize learning)
    -tgt_tok       FILE : if provided, json tokenization options for onmt tokenization, points to vocabulary file
    -tgt_voc       FILE : vocabulary of tgt words (needed to initialize learning)
+   -tok_workers    INT : number of processes used to tokenize data when tokenization options are used [1]
    -src_emb       FILE : embeddings of src words (needed to initialize learning)
    -tgt_emb       FILE : embeddings of tgt words (needed to initialize learning)
    -src_emb_size   INT : size of src embeddings if -src_emb not used
@@ -37,6 +57,8 @@ class Config():
 
    -src_lstm_size  INT : hidden units for src bi-lstm [256]
    -tgt_lstm_size  INT : hidden units for tgt bi-lstm [256]
+   -lstm_impl   STRING : bi-lstm implementation: basic (LSTMCell, a loop of ops per time step) or fused
+                         (LSTMBlockFusedCell, a single op per sequence), models can be used with both [basic]
 
    -lr           FLOAT : initial learning rate [1.0]
    -lr_decay     FLOAT : learning rate decay [0.9]
@@ -46,8 +68,13 @@ class Config():
    -dropout      FLOAT : dropout ratio [0.3]
    -mode        STRING : mode (alignment, sentence) [alignment]
    -max_sents      INT : Consider this number of sentences per batch (0 for all) [0]
+   -bucket         INT : sort training examples by length within pools of this many batches (0 for no sorting) [0]
    -n_epochs       INT : train for this number of epochs [1]
+   -shuffle_buffer INT : stream data files instead of loading them in memory, training examples are shuffled
+                         through a buffer of this many examples (0 to load all data in memory) [0]
    -report_every   INT : report every this many batches [1000]
+   -profile_steps  A:B : trace training steps A to B (counted from 1 over all epochs of this run), a chrome trace
+                         per step (mdir/timeline.stepN.json) and a summary of op costs (mdir/profile.txt) are written
 
  [INFERENCE OPTIONS]
    -epoch          INT : epoch to use (mdir]/epoch[epoch], by default the latest one in mdir)
@@ -59,11 +86,34 @@ class Config():
    -show_align         : output source/target alignment matrix (mode must be alignment)
    -show_last          : output source/target last vectors
    -show_aggr          : output source/target aggr vectors
+   -cascade   LOW:HIGH : two-stage scoring (mode must be alignment): align and aggr outputs are only computed for
+                         pairs with a cosine similarity in ]LOW, HIGH[, words of the other pairs are predicted from
+                         their similarity (parallel when >= HIGH, divergent when <= LOW) [none]
+   -encode        FILE : encode the sentences of this file (one per line) with the -side encoder: last vectors are
+                         written in -output as .npy (one row per line), each unique sentence is encoded once
+   -side        STRING : encoder used by -encode: src or tgt [src]
+   -fp16               : -encode vectors are written as float16 (float32 otherwise)
+   -serve      ADDRESS : serve similarity scores over http on HOST:PORT (or unix:PATH for a unix socket) instead of
+                         -tst: POST /score with a pair per line (src tab tgt) answers a score per line, GET /stats
+                         answers json stats (latency percentiles, batches), concurrent requests are batched
+                         together up to -batch_size pairs (-batch_tokens padded cells if set)
+   -max_wait_ms    INT : -serve: a batch is run once its first request has waited this many milliseconds [5]
 
 + Options marked with * must be set. The other ones have default values.
 + If -mdir exists in learning mode, learning continues after restoring the last model
 + Training data is shuffled at every epoch
++ With -bucket, batches contain examples of similar lengths (less padding) and are output in random order
++ With -cache, embeddings (-src_emb, -tgt_emb) filtered by vocabulary are also cached (.npy) in that directory
++ -trn, -dev and -tst can also be binary corpora compiled with build_bin.py (memory-mapped, no text parsing)
 + -show_last, -show_aggr and -show_align can be used at the same time
++ Learning curves can be printed from json metrics with: python tool/curves.py mdir/metrics.jsonl
++ Progress lines include seconds spent per stage since the last report (per epoch in TRAIN/VALID/TEST lines),
+  pairs/s, tok/s (src/tgt), %pad (src/tgt) and peak memory (rss)
++ Only what is output is computed: with -q alignments are not computed (unless -tst contains word tags)
++ -encode output is memory-mappable: np.load(FILE, mmap_mode='r'), the unique sentence of every line is written in
+  FILE.inverse.npy (FILE without .npy)
++ With -cascade, the fraction of pairs run by each stage is written in a CASCADE line
++ -serve keeps the model loaded until interrupted (Ctrl-C), load can be tested with src/loadtest.py
 """.format(argv.pop(0))
 
         self.src_voc = None
@@ -84,11 +134,15 @@ class Config():
         self.dev = None
         self.tst = None
         self.output = '-'
+        self.cache = None
+        self.encode_once = False
+        self.stats = None
         self.emb_src = None
         self.emb_tgt = None
 
         self.src_lstm_size = 256
         self.tgt_lstm_size = 256
+        self.lstm_impl = "basic"
 
         self.aggr = "lse"
         self.r = 1.0
@@ -99,12 +153,23 @@ class Config():
 
         self.seq_size = 50
         self.batch_size = 32
+        self.batch_tokens = 0
+        self.prefetch = 0
+        self.async_score = False
+        self.intra_threads = 0
+        self.inter_threads = 0
+        self.procs = None
+        self.xla = False
         self.max_sents = 0
+        self.bucket = 0
         self.n_epochs = 1
+        self.shuffle_buffer = 0
+        self.tok_workers = 1
         # epochs already run
         self.last_epoch = 0
         self.seed = 1234
         self.report_every = 1000
+        self.profile_steps = None
         self.debug = False
         self.mode = "alignment"
 
@@ -114,17 +179,22 @@ class Config():
         self.show_last = False
         self.show_aggr = False
         self.show_align = False
+        self.encode = None
+        self.side = "src"
+        self.cascade = None
+        self.serve = None
+        self.max_wait_ms = 5
+        self.fp16 = False
 
         self.parse(argv)
 
-        tf.set_random_seed(self.seed)
         np.random.seed(self.seed)
 
         if not self.mdir:
             sys.stderr.write("error: Missing -mdir option\n{}".format(self.usage))
             sys.exit(1)
 
-        if self.tst:
+        if self.tst or self.encode or self.serve:
             self.inference()
         if self.trn:
             self.learn()
@@ -147,11 +217,26 @@ class Config():
             if not self.epoch:
                 sys.stderr.write("error: Cannot find epoch in mdir '{}'\n{}".format(self.mdir, self.usage))
                 sys.exit(1)
-        check_dataset(self.tst)
-        if self.output == '-':
-            self.output = sys.stdout
+        if sum(1 for opt in [self.tst, self.encode, self.serve] if opt) > 1:
+            sys.stderr.write('error: -tst, -encode and -serve cannot be used at the same time\n')
+            sys.exit(1)
+        if self.serve:
+            if parse_address(self.serve) is None:
+                sys.stderr.write('error: bad -serve address {} (use HOST:PORT or unix:PATH)\n'.format(self.serve))
+                sys.exit(1)
+        elif self.encode:
+            if not os.path.exists(self.encode):
+                sys.stderr.write('error: -encode file {} cannot be find\n'.format(self.encode))
+                sys.exit(1)
+            if self.output == '-':
+                sys.stderr.write('error: -encode needs -output FILE (.npy)\n')
+                sys.exit(1)
         else:
-            self.output = open(self.output, "wb")
+            check_dataset(self.tst)
+            if self.output == '-':
+                self.output = sys.stdout
+            else:
+                self.output = open(self.output, "wb")
         if not os.path.exists('{}/epoch{}.index'.format(self.mdir, self.epoch)):
             sys.stderr.write('error: -epoch file {}/epoch{}.index cannot be find\n'.format(self.mdir, self.epoch))
             sys.exit(1)
@@ -185,6 +270,9 @@ class Config():
                 argv.append(val)
         # overrides options passed in command line
         self.parse(argv)
+        if self.cascade is not None and (self.mode != "alignment" or self.show_svg or self.show_matrix):
+            sys.stderr.write('error: -cascade needs alignment mode (and cannot be used with -show_svg/-show_matrix)\n')
+            sys.exit(1)
 
         # read vocabularies
         self.voc_src = Vocab(self.mdir + "/" + src_voc)
@@ -292,11 +380,12 @@ class Config():
                 copyfile(self.tgt_voc, self.mdir + "/vocab_tgt")
 
             # read embeddings
+            # cached embeddings are kept in -cache directory (a new -mdir would never reuse them)
             # read file or use emb_src.length if file is not set
-            self.emb_src = Embeddings(self.src_emb, self.voc_src, self.src_emb_size)
+            self.emb_src = Embeddings(self.src_emb, self.voc_src, self.src_emb_size, self.cache)
             self.src_emb_size = self.emb_src.dim
             # read file or use emb_tgt.length if file is not set
-            self.emb_tgt = Embeddings(self.tgt_emb, self.voc_tgt, self.tgt_emb_size)
+            self.emb_tgt = Embeddings(self.tgt_emb, self.voc_tgt, self.tgt_emb_size, self.cache)
             self.tgt_emb_size = self.emb_tgt.dim
             # write topology file
             with open(self.mdir + "/topology", 'w') as f:
@@ -305,6 +394,10 @@ class Config():
                             opt == "aggr" or opt == "mode":
                         f.write("{} {}\n".format(opt, val))
             print("learning from scratch")
+
+        # learning metrics are appended as json lines next to the model (unless -stats is used)
+        if self.stats is None:
+            self.stats = self.mdir + "/metrics.jsonl"
         return
 
     def parse(self, argv):
@@ -340,28 +433,71 @@ class Config():
                 self.dev = argv.pop(0)
             elif (tok == "-tst" and len(argv)):
                 self.tst = argv.pop(0)
+            elif (tok == "-cache" and len(argv)):
+                self.cache = argv.pop(0)
             elif (tok == "-output" and len(argv)):
                 self.output = argv.pop(0)
             elif (tok == "-max_sents" and len(argv)):
                 self.max_sents = int(argv.pop(0))
+            elif (tok == "-bucket" and len(argv)):
+                self.bucket = int(argv.pop(0))
+            elif (tok == "-encode_once"):
+                self.encode_once = True
+            elif (tok == "-stats" and len(argv)):
+                self.stats = argv.pop(0)
             elif (tok == "-debug"):
                 self.debug = True
             elif (tok == "-seed" and len(argv)):
                 self.seed = int(argv.pop(0))
             elif (tok == "-report_every" and len(argv)):
                 self.report_every = int(argv.pop(0))
+            elif (tok == "-profile_steps" and len(argv)):
+                self.profile_steps = argv.pop(0)
+                if parse_steps(self.profile_steps) is None:
+                    sys.stderr.write('error: bad -profile_steps value {} (use A:B with 1 <= A <= B)\n'.format(
+                        self.profile_steps))
+                    sys.exit(1)
             elif (tok == "-n_epochs" and len(argv)):
                 self.n_epochs = int(argv.pop(0))
+            elif (tok == "-shuffle_buffer" and len(argv)):
+                self.shuffle_buffer = int(argv.pop(0))
+            elif (tok == "-tok_workers" and len(argv)):
+                self.tok_workers = int(argv.pop(0))
 
             elif (tok == "-src_lstm_size" and len(argv)):
                 self.src_lstm_size = int(argv.pop(0))
             elif (tok == "-tgt_lstm_size" and len(argv)):
                 self.tgt_lstm_size = int(argv.pop(0))
+            elif (tok == "-lstm_impl" and len(argv)):
+                self.lstm_impl = argv.pop(0)
+                if self.lstm_impl != "basic" and self.lstm_impl != "fused":
+                    sys.stderr.write('error: bad -lstm_impl option \'{}\' (use basic or fused)\n'.format(
+                        self.lstm_impl))
+                    sys.exit(1)
 
             elif (tok == "-seq_size" and len(argv)):
                 self.seq_size = int(argv.pop(0))
             elif (tok == "-batch_size" and len(argv)):
                 self.batch_size = int(argv.pop(0))
+            elif (tok == "-batch_tokens" and len(argv)):
+                self.batch_tokens = int(argv.pop(0))
+            elif (tok == "-prefetch" and len(argv)):
+                self.prefetch = int(argv.pop(0))
+            elif (tok == "-async_score"):
+                self.async_score = True
+            elif (tok == "-intra_threads" and len(argv)):
+                self.intra_threads = int(argv.pop(0))
+            elif (tok == "-inter_threads" and len(argv)):
+                self.inter_threads = int(argv.pop(0))
+            elif (tok == "-procs" and len(argv)):
+                self.procs = argv.pop(0)
+                procs = self.procs.split(':')
+                if len(procs) != 2 or not procs[0].isdigit() or not procs[1].isdigit() or \
+                        int(procs[1]) >= int(procs[0]):
+                    sys.stderr.write('error: bad -procs value {} (use N:I with 0 <= I < N)\n'.format(self.procs))
+                    sys.exit(1)
+            elif (tok == "-xla"):
+                self.xla = True
             elif (tok == "-aggr" and len(argv)):
                 self.aggr = argv.pop(0)
             elif (tok == "-r" and len(argv)):
@@ -389,6 +525,29 @@ class Config():
                 self.show_last = True
             elif tok == "-show_align":
                 self.show_align = True
+            elif (tok == "-cascade" and len(argv)):
+                self.cascade = argv.pop(0)
+                try:
+                    low, high = map(float, self.cascade.split(':'))
+                except ValueError:
+                    low, high = 0.0, 0.0
+                if low >= high:
+                    sys.stderr.write('error: bad -cascade value {} (use LOW:HIGH with LOW < HIGH)\n'.format(
+                        self.cascade))
+                    sys.exit(1)
+            elif (tok == "-encode" and len(argv)):
+                self.encode = argv.pop(0)
+            elif (tok == "-side" and len(argv)):
+                self.side = argv.pop(0)
+                if self.side != "src" and self.side != "tgt":
+                    sys.stderr.write('error: bad -side option \'{}\' (use src or tgt)\n'.format(self.side))
+                    sys.exit(1)
+            elif tok == "-fp16":
+                self.fp16 = True
+            elif (tok == "-serve" and len(argv)):
+                self.serve = argv.pop(0)
+            elif (tok == "-max_wait_ms" and len(argv)):
+                self.max_wait_ms = int(argv.pop(0))
 
             elif tok == "-h":
                 sys.stderr.write("{}".format(self.usage))
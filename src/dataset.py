@@ -3,13 +3,20 @@
 import os.path
 import io
 from math import *
-from random import shuffle
+from random import shuffle, randint
 import numpy as np
 import sys
 import time
 import gzip
+import json
+import hashlib
+import six
+import threading
+from six.moves import queue, map
+from array import array
+from itertools import chain, repeat
 from collections import defaultdict
-from tokenizer import build_tokenizer
+from tokenizer import PairTokenizer
 
 reload(sys)
 sys.setdefaultencoding('utf8')
@@ -23,8 +30,18 @@ str_pad = "<pad>"
 
 class Embeddings():
 
-    def __init__(self, file, voc, length):
-        w2e = {}
+    def __init__(self, file, voc, length, cache=None):
+        if file is not None and cache is not None:
+            ### vocab-filtered normalized matrix is saved/restored as .npy
+            cache = '{}/embeddings.{}.npy'.format(cache, embeddings_key(file, voc))
+            if os.path.exists(cache):
+                self.matrix = np.load(cache)
+                self.dim = self.matrix.shape[1]
+                sys.stderr.write('Read cached embeddings {} [{}x{}]\n'.format(cache, len(voc), self.dim))
+                return
+
+        idxs = []
+        vecs = []
         if file is not None:
             if file.endswith('.gz'):
                 f = gzip.open(file, 'rb')
@@ -33,6 +50,8 @@ class Embeddings():
 
             self.num, self.dim = map(int, f.readline().split())
             i = 0
+            words = []
+            lines = []
             for line in f:
                 i += 1
                 if i % 10000 == 0:
@@ -40,74 +59,135 @@ class Embeddings():
                         sys.stderr.write("{}".format(i))
                     else:
                         sys.stderr.write(".")
-                tokens = line.rstrip().split(' ')
-                if voc.exists(tokens[0]):
-                    w2e[tokens[0]] = tokens[1:]
+                ### only the word is parsed here, words are looked up in vocab by blocks
+                tokens = line.rstrip().split(' ', 1)
+                if len(tokens) == 2 and tokens[0] != str_unk and tokens[0] != str_pad:
+                    words.append(tokens[0])
+                    lines.append(tokens[1])
+                if len(words) == 100000:
+                    self.keep_vocab_words(voc, words, lines, idxs, vecs)
+                    words = []
+                    lines = []
+            self.keep_vocab_words(voc, words, lines, idxs, vecs)
             f.close()
-            sys.stderr.write('Read {} embeddings ({} missing in voc)\n'.format(len(w2e), len(voc)-len(w2e)))
+            sys.stderr.write('Read {} embeddings ({} missing in voc)\n'.format(len(idxs), len(voc)-len(idxs)))
         else:
             sys.stderr.write('Embeddings file not used! will be initialised to [{}x{}]\n'.format(len(voc), length))
             self.dim = length
 
         # i need an embedding for each word in voc
         # embedding matrix must have tokens in same order than voc 0:<unk>, 1:<pad>, 2:le, ...
-        self.matrix = []
-        for tok in voc:
-            if tok == str_unk or tok == str_pad or tok not in w2e:
-                ### random initialize these tokens
-                self.matrix.append(np.random.normal(0, 1.0, self.dim))
-            else:
-                self.matrix.append(np.asarray(w2e[tok], dtype=np.float32))
-
-        self.matrix = np.asarray(self.matrix, dtype=np.float32)
+        ### random initialize tokens not found (and <unk>, <pad>)
+        self.matrix = np.random.normal(0, 1.0, (len(voc), self.dim)).astype(np.float32)
+        if len(idxs):
+            self.matrix[idxs] = np.fromstring(" ".join(vecs), dtype=np.float32, sep=' ').reshape(len(idxs), self.dim)
         self.matrix = self.matrix / np.sqrt((self.matrix ** 2).sum(1))[:, None]
 
+        if file is not None and cache is not None:
+            if not os.path.exists(os.path.dirname(cache)):
+                os.makedirs(os.path.dirname(cache))
+            np.save(cache, self.matrix)
+
+    def keep_vocab_words(self, voc, words, lines, idxs, vecs):
+        ### vectors of vocab words are converted all at once
+        if len(words) == 0:
+            return
+        widxs, found = voc.lookup(words)
+        for j in np.flatnonzero(found):
+            idxs.append(widxs[j])
+            vecs.append(lines[j])
+
+
+def embeddings_key(file, voc):
+    """names cached embeddings after the embeddings file (path, size, modification time) and vocabulary"""
+    stat = os.stat(file)
+    h = hashlib.sha1()
+    h.update("{} {} {}".format(os.path.abspath(file), stat.st_size, stat.st_mtime))
+    h.update(voc.digest())
+    return h.hexdigest()
+
 
 class Vocab():
 
     def __init__(self, dict_file):
-        self.tok_to_idx = {}
-        self.idx_to_tok = []
-        self.idx_to_tok.append(str_unk)
-        self.tok_to_idx[str_unk] = len(self.tok_to_idx)
-        self.idx_to_tok.append(str_pad)
-        self.tok_to_idx[str_pad] = len(self.tok_to_idx)
-        nline = 0
-        for line in [line.rstrip('\n') for line in open(dict_file)]:
-            nline += 1
-            line = line.strip()
-            self.idx_to_tok.append(line)
-            self.tok_to_idx[line] = len(self.tok_to_idx)
-
-        self.length = len(self.idx_to_tok)
+        if is_npy(dict_file):
+            ### binary vocab (see build_vocab.py) is memory-mapped, it already contains <unk> and <pad>
+            self.toks = np.load(dict_file, mmap_mode='r')
+        else:
+            toks = [str_unk, str_pad]
+            for line in open(dict_file):
+                toks.append(line.strip())
+            ### object array: an unusually long token does not widen every entry
+            self.toks = np.array(toks, dtype=object)
+        ### token => index hash table, built on first lookup (decode only needs self.toks)
+        self.index = None
+        self.length = len(self.toks)
         sys.stderr.write('Read vocab ({} entries)\n'.format(self.length))
 
     def __len__(self):
-        return len(self.idx_to_tok)
+        return self.length
 
     def __iter__(self):
-        for tok in self.idx_to_tok:
+        for tok in self.toks.tolist():
             yield tok
 
+    def build_index(self):
+        ### the last of equal tokens wins, as when the vocab was read into a dict
+        self.index = dict(zip(self.toks.tolist(), range(self.length)))
+
+    def lookup(self, tokens):
+        """returns the indexs of tokens and whether they were found in vocab"""
+        if self.index is None:
+            self.build_index()
+        idxs = np.fromiter(map(self.index.get, tokens, repeat(-1)), dtype=np.int32, count=len(tokens))
+        found = idxs >= 0
+        return np.maximum(idxs, 0), found
+
+    def encode(self, tokens):
+        """list of tokens => np.int32 array of indexs (idx_unk if not found)"""
+        if self.index is None:
+            self.build_index()
+        return np.fromiter(map(self.index.get, tokens, repeat(idx_unk)), dtype=np.int32, count=len(tokens))
+
+    def decode(self, idxs):
+        """indexs => list of tokens"""
+        return self.toks[np.asarray(idxs, dtype=np.int64)].tolist()
+
     def exists(self, s):
-        return s in self.tok_to_idx
+        if self.index is None:
+            self.build_index()
+        return s in self.index
+
+    def digest(self):
+        return hashlib.sha1("\n".join(self.toks.tolist())).hexdigest()
 
     def get(self, s):
         if type(s) == int:
             ### We want the string
-            if s < len(self.idx_to_tok):
-                return self.idx_to_tok[s]
+            if s < self.length:
+                return self.toks[s]
             else:
                 sys.stderr.write('error: key \'{}\' not found in vocab\n'.format(s))
                 sys.exit(1)
         ### We want the index
-        if s not in self.tok_to_idx:
-            return idx_unk
-        return self.tok_to_idx[s]
+        return int(self.encode([s])[0])
+
+
+def is_npy(file):
+    """numpy binary files start with a magic string"""
+    with open(file, 'rb') as f:
+        return f.read(6) == b'\x93NUMPY'
+
+
+def is_binary(filepath):
+    """binary corpora (see compile_dataset) are given by the prefix of their files"""
+    return os.path.exists(filepath + '.meta')
 
 
 def check_dataset(filepath):
-    """file is either multi-column file, or a collection of files comma-aligned"""
+    """file is either multi-column file, or a collection of files comma-aligned, or a binary corpus"""
+    if is_binary(filepath):
+        return True
     files = filepath.split(",")
     assert len(files) == 1 or len(files) == 2 or len(files) == 4, "invalid number of files in dataset"
     for file in files:
@@ -117,30 +197,89 @@ def check_dataset(filepath):
     return True
 
 
+def split_chunk(values, sents):
+    """flat array of the words of a chunk of sentences => one list per sentence"""
+    values = values.tolist()
+    seqs = []
+    ini = 0
+    for sent in sents:
+        seqs.append(values[ini:ini+len(sent)])
+        ini += len(sent)
+    return seqs
+
+
+def tags_array(tags_txt, sents):
+    """flat array of the tags of a chunk of sentences (-1.0 if not annotated)"""
+    tags = np.full(sum(len(sent) for sent in sents), -1.0, dtype=np.float32)
+    if all(t is None for t in tags_txt):
+        return tags
+    txt = np.array(list(chain.from_iterable(t if t is not None else ['-1.0']*len(s) for t, s in zip(tags_txt, sents))))
+    tags[txt != '-1.0'] = 1.0
+    return tags
+
+
 class Dataset():
 
-    def __init__(self, filepath, voc_src, tok_src, voc_tgt, tok_tgt, seq_size, max_sents, do_shuffle, do_skip_empty):
+    def __init__(self, filepath, voc_src, tok_src, voc_tgt, tok_tgt, seq_size, max_sents, do_shuffle, do_skip_empty,
+                 stream=False, shuffle_buffer=0, tok_workers=1, cache=None, encode_once=False):
+        self.tokenizer = None
         if filepath is None:
             return
+        self.filepath = filepath
         self.voc_src = voc_src
+        self.tok_src = tok_src
+        self.tok_tgt = tok_tgt
         self.voc_tgt = voc_tgt
         self.files = filepath.split(",")
         self.seq_size = seq_size
         self.max_sents = max_sents
         self.do_shuffle = do_shuffle
         self.do_skip_empty = do_skip_empty
+        self.stream = stream
+        self.shuffle_buffer = shuffle_buffer
+        ### lines are tokenized by blocks (sharded over tok_workers processes)
+        self.tok_workers = tok_workers
+        self.block_size = 1000 * max(1, tok_workers)
         self.annotated = False
+        self.binary = False
+        ### examples are kept encoded after the first complete iteration (not when streaming)
+        self.encode_once = encode_once and not stream
+        self.encoded = False
         self.data = []
         ### length of the data set to be used (not necessarily the whole set)
         self.length = 0
 
-        src_tokenizer = None
-        tgt_tokenizer = None
-        if tok_src:
-            src_tokenizer = build_tokenizer(tok_src)
-        if tok_tgt:
-            tgt_tokenizer = build_tokenizer(tok_tgt)
+        if is_binary(filepath):
+            self.read_binary(filepath)
+            return
+        if cache is not None:
+            self.read_cache(cache)
+            return
+
+        if self.tok_src or self.tok_tgt:
+            ### created once: worker processes are forked before the session and threads exist, and are reused by
+            ### every pass over a streamed file (closed by close())
+            self.tokenizer = PairTokenizer(self.tok_src, self.tok_tgt, self.tok_workers)
+        if self.stream:
+            ### lines are read lazily (at every epoch), only the line count is computed here
+            self.length = count_lines(self.files[0])
+            self.peek_columns()
+        else:
+            for _, line in self.read_lines():
+                self.data.append(line)
+            self.length = len(self.data)
+            self.close()
+        sys.stderr.write('({} contains {} examples)\n'.format(filepath, self.length))
+
+        if self.max_sents > 0:
+            self.length = min(self.length, self.max_sents)
 
+    def close(self):
+        if self.tokenizer is not None:
+            self.tokenizer.close()
+            self.tokenizer = None
+
+    def read_lines(self):
         # file handlers
         fhs = []
         for file in self.files:
@@ -152,36 +291,179 @@ class Dataset():
         firstline = True
         count_column = None
         idx = 0
-        for line in fhs[0]:
-            idx += 1
-            if len(fhs) > 1:
-                # read from multiple files
-                lsplit = [line]
-                for fh in fhs[1:]:
-                    lsplit.append(fh.readline().strip())
-            else:
-                # or for one single file
-                lsplit = line.split('\t')
-            if firstline:
-                assert len(lsplit) >= 2 and len(lsplit) <= 4, "invalid column count in {}".format(filepath)
-                count_column = len(lsplit)
-                if len(lsplit) == 4:
-                    self.annotated = True
-                firstline = False
+        block = []
+        try:
+            for line in fhs[0]:
+                idx += 1
+                if len(fhs) > 1:
+                    # read from multiple files
+                    lsplit = [line]
+                    for fh in fhs[1:]:
+                        lsplit.append(fh.readline().strip())
+                else:
+                    # or for one single file
+                    lsplit = line.split('\t')
+                if firstline:
+                    assert len(lsplit) >= 2 and len(lsplit) <= 4, "invalid column count in {}".format(self.filepath)
+                    count_column = len(lsplit)
+                    if len(lsplit) == 4:
+                        self.annotated = True
+                    firstline = False
+                else:
+                    assert len(lsplit) == count_column, "invalid column count in {}, line {}".format(
+                        self.filepath, idx)
+                block.append(lsplit)
+                if len(block) == self.block_size:
+                    for i, lsplit in enumerate(self.tokenize_block(block)):
+                        yield idx-len(block)+i, "\t".join(lsplit)
+                    block = []
+            for i, lsplit in enumerate(self.tokenize_block(block)):
+                yield idx-len(block)+i, "\t".join(lsplit)
+        finally:
+            for fh in fhs:
+                fh.close()
+
+    def tokenize_block(self, block):
+        if self.tokenizer is None:
+            return block
+        return self.tokenizer.tokenize(block)
+
+    def peek_columns(self):
+        ### sets self.annotated from the first line
+        if len(self.files) > 1:
+            ncolumns = len(self.files)
+        else:
+            if self.files[0].endswith('.gz'):
+                f = gzip.open(self.files[0], 'rb')
             else:
-                assert len(lsplit) == count_column, "invalid column count in {}, line {}".format(filepath, idx)
-            if src_tokenizer:
-                tokens, _ = src_tokenizer.tokenize(str(lsplit[0]))
-                lsplit[0] = " ".join(tokens)
-            if tgt_tokenizer:
-                tokens, _ = tgt_tokenizer.tokenize(str(lsplit[1]))
-                lsplit[1] = " ".join(tokens)
-            self.data.append("\t".join(lsplit))
-            self.length += 1
+                f = open(self.files[0], 'rb')
+            ncolumns = len(f.readline().split('\t'))
+            f.close()
+        self.annotated = ncolumns == 4
 
+    def stream_lines(self):
+        if not self.do_shuffle:
+            for entry in self.read_lines():
+                yield entry
+            return
+        ### a random entry of the buffer is output and replaced by the next one read
+        buff = []
+        for entry in self.read_lines():
+            if len(buff) < self.shuffle_buffer:
+                buff.append(entry)
+                continue
+            i = randint(0, len(buff)-1)
+            yield buff[i]
+            buff[i] = entry
+        shuffle(buff)
+        for entry in buff:
+            yield entry
+
+    def read_cache(self, cache):
+        ### data is tokenized and mapped to vocab ids once, then reused as a binary corpus
+        prefix = cache_prefix(cache, self.filepath, self.tok_src, self.tok_tgt, self.voc_src, self.voc_tgt,
+                              self.do_skip_empty)
+        if is_binary(prefix):
+            sys.stderr.write('Using cached {} for {}\n'.format(prefix, self.filepath))
+        else:
+            if not os.path.exists(cache):
+                os.makedirs(cache)
+            data = Dataset(self.filepath, self.voc_src, self.tok_src, self.voc_tgt, self.tok_tgt, seq_size=0,
+                           max_sents=0, do_shuffle=False, do_skip_empty=self.do_skip_empty, stream=True,
+                           tok_workers=self.tok_workers)
+            ### compiled under a temporary name, files are renamed once complete (.meta the last one)
+            tmp = '{}.tmp{}'.format(prefix, os.getpid())
+            try:
+                compile_dataset(data, tmp)
+            except BaseException:
+                ### incomplete files are not left in the cache
+                for ext in binary_files:
+                    if os.path.exists('{}.{}'.format(tmp, ext)):
+                        os.remove('{}.{}'.format(tmp, ext))
+                raise
+            finally:
+                data.close()
+            for ext in binary_files:
+                os.rename('{}.{}'.format(tmp, ext), '{}.{}'.format(prefix, ext))
+        self.read_binary(prefix)
+
+    def read_binary(self, prefix):
+        ### flat arrays are memory-mapped, nothing is loaded until examples are used
+        meta = {}
+        with open(prefix + '.meta', 'r') as f:
+            for line in f:
+                key, val = line.split()
+                meta[key] = int(val)
+        if meta['src_voc_size'] != len(self.voc_src) or meta['tgt_voc_size'] != len(self.voc_tgt):
+            sys.stderr.write('error: binary corpus {} was compiled with vocab sizes {}/{} (current are {}/{})\n'.format(
+                prefix, meta['src_voc_size'], meta['tgt_voc_size'], len(self.voc_src), len(self.voc_tgt)))
+            sys.exit(1)
+        self.binary = True
+        self.annotated = meta['annotated'] == 1
+        arrays = {}
+        for ext in binary_files[:-1]:
+            arrays[ext] = open_memmap('{}.{}'.format(prefix, ext), binary_dtypes[ext.split('.')[1]])
+        self.set_arrays(arrays, meta['examples'])
+        sys.stderr.write('({} contains {} examples)\n'.format(prefix, self.nexamples))
+
+    def set_arrays(self, arrays, nexamples):
+        ### examples are read from flat arrays (either memory-mapped or in memory)
+        self.nexamples = nexamples
+        self.src_ids = arrays['src.ids']
+        self.tgt_ids = arrays['tgt.ids']
+        self.src_tags = arrays['src.tags']
+        self.tgt_tags = arrays['tgt.tags']
+        self.src_offs = arrays['src.offs']
+        self.tgt_offs = arrays['tgt.offs']
+        self.src_txt = arrays['src.txt']
+        self.tgt_txt = arrays['tgt.txt']
+        self.src_toffs = arrays['src.toffs']
+        self.tgt_toffs = arrays['tgt.toffs']
+        self.counts = None
+        self.length = self.nexamples
         if self.max_sents > 0:
             self.length = min(self.length, self.max_sents)
-        sys.stderr.write('({} contains {} examples)\n'.format(filepath, len(self.data)))
+
+    def count_records(self):
+        ### per-example unk/divergent counts, computed once
+        if self.counts is None:
+            self.counts = {
+                'unk_src': segment_counts(self.src_ids, self.src_offs, idx_unk),
+                'unk_tgt': segment_counts(self.tgt_ids, self.tgt_offs, idx_unk),
+                'div_src': segment_counts(self.src_tags, self.src_offs, 1),
+                'div_tgt': segment_counts(self.tgt_tags, self.tgt_offs, 1)}
+        return self.counts
+
+    def iter_binary(self):
+        nsent = 0
+        counts = self.count_records()
+        indexs = [i for i in range(self.nexamples)]
+        if self.do_shuffle:
+            shuffle(indexs)
+        for index in indexs:
+            s_ini, s_end = self.src_offs[index], self.src_offs[index+1]
+            t_ini, t_end = self.tgt_offs[index], self.tgt_offs[index+1]
+            if self.seq_size > 0 and (s_end - s_ini > self.seq_size or t_end - t_ini > self.seq_size):
+                # filter out examples with more than seq_size tokens
+                continue
+            isrc = self.src_ids[s_ini:s_end].tolist()
+            itgt = self.tgt_ids[t_ini:t_end].tolist()
+            src_tag = self.src_tags[s_ini:s_end].astype(np.float32).tolist()
+            tgt_tag = self.tgt_tags[t_ini:t_end].astype(np.float32).tolist()
+            src = self.src_txt[self.src_toffs[index]:self.src_toffs[index+1]].tobytes().split(' ')
+            tgt = self.tgt_txt[self.tgt_toffs[index]:self.tgt_toffs[index+1]].tobytes().split(' ')
+            ### totals are sums of precomputed counts
+            self.nunk_src += counts['unk_src'][index]
+            self.nunk_tgt += counts['unk_tgt'][index]
+            self.ndiv_src += counts['div_src'][index]
+            self.ndiv_tgt += counts['div_tgt'][index]
+            self.nsrc += len(isrc)
+            self.ntgt += len(itgt)
+            yield isrc, itgt, src, tgt, src_tag, tgt_tag
+            nsent += 1
+            if self.max_sents > 0 and nsent > self.max_sents:
+                # already generated max_sents examples
+                break
 
     def __iter__(self):
         nsent = 0
@@ -191,15 +473,43 @@ class Dataset():
         self.nunk_tgt = 0
         self.ndiv_src = 0
         self.ndiv_tgt = 0
-        ### every iteration i get shuffled data examples if do_shuffle
-        indexs = [i for i in range(len(self.data))]
-        if self.do_shuffle:
-            shuffle(indexs)
-        for index in indexs:
-            tokens = self.data[index].strip().split('\t')
+        if self.binary or self.encoded:
+            for example in self.iter_binary():
+                yield example
+            return
+        if self.stream:
+            entries = self.stream_lines()
+        else:
+            ### every iteration i get shuffled data examples if do_shuffle
+            indexs = [i for i in range(len(self.data))]
+            if self.do_shuffle:
+                shuffle(indexs)
+            entries = ((index, self.data[index]) for index in indexs)
+        encoded = EncodedExamples() if self.encode_once else None
+        for isrc, itgt, src, tgt, src_tag, tgt_tag in self.build_examples(self.parse_entries(entries)):
+            self.keep_records(src_tag, tgt_tag, isrc, itgt)
+            if encoded is not None:
+                encoded.add(isrc, itgt, src, tgt, src_tag, tgt_tag)
+            yield isrc, itgt, src, tgt, src_tag, tgt_tag
+            nsent += 1
+            if self.max_sents > 0 and nsent > self.max_sents:
+                # already generated max_sents examples
+                break
+        else:
+            if encoded is not None:
+                ### all data was iterated: next iterations use the encoded examples, text lines are released
+                self.set_arrays(encoded.arrays(), encoded.nexamples)
+                self.encoded = True
+                self.data = []
+
+    def __len__(self):
+        return self.length
+
+    def parse_entries(self, entries):
+        for index, line in entries:
+            tokens = line.strip().split('\t')
             if len(tokens) != 2 and len(tokens) != 4:
-                sys.stderr.write("warning: bad data entry \'{}\' in line={}".format(
-                    self.data[index], index+1))
+                sys.stderr.write("warning: bad data entry \'{}\' in line={}".format(line, index+1))
                 if self.do_skip_empty:
                     sys.stderr.write(" [skipped]\n")
                     continue
@@ -218,51 +528,38 @@ class Dataset():
                 continue
             if len(tokens) == 2:
                 ### test set without annotations
-                src_tag_txt = ['-1.0' for i in src]
-                tgt_tag_txt = ['-1.0' for i in tgt]
+                src_tag_txt = None
+                tgt_tag_txt = None
             else:
                 src_tag_txt = tokens[2].split(' ')
                 tgt_tag_txt = tokens[3].split(' ')
                 if len(tgt_tag_txt) != len(tgt) or len(src_tag_txt) != len(src):
                     sys.stderr.write("warning: diff num of words/tags \'{}\' in line={} [skipped]\n".format(
-                        self.data[index], index+1))
+                        line, index+1))
                     continue
-
-            isrc, itgt, src_tag, tgt_tag = self.build_example(src, tgt, src_tag_txt, tgt_tag_txt)
-            self.keep_records(src_tag, tgt_tag, isrc, itgt)
-            yield isrc, itgt, src, tgt, src_tag, tgt_tag
-            nsent += 1
-            if self.max_sents > 0 and nsent > self.max_sents:
-                # already generated max_sents examples
-                break
-
-    def __len__(self):
-        return self.length
-
-    def build_example(self, src, tgt, src_tag_txt, tgt_tag_txt):
-        isrc = []
-        src_tag = []
-        i = 0
-        for s in src:
-            isrc.append(self.voc_src.get(s))
-            if src_tag_txt[i] == '-1.0':
-                src_tag.append(-1.0)
-            else:
-                src_tag.append(1.0)
-            i += 1
-
-        itgt = []
-        tgt_tag = []
-        i = 0
-        for t in tgt:
-            itgt.append(self.voc_tgt.get(t))
-            if tgt_tag_txt[i] == '-1.0':
-                tgt_tag.append(-1.0)
-            else:
-                tgt_tag.append(1.0)
-            i += 1
-
-        return isrc, itgt, src_tag, tgt_tag
+            yield src, tgt, src_tag_txt, tgt_tag_txt
+
+    def build_examples(self, parsed):
+        ### words are mapped to vocab indexs by chunks of examples (one vocab lookup per chunk and side)
+        chunk = []
+        for example in parsed:
+            chunk.append(example)
+            if len(chunk) == 1000:
+                for example in self.build_chunk(chunk):
+                    yield example
+                chunk = []
+        for example in self.build_chunk(chunk):
+            yield example
+
+    def build_chunk(self, chunk):
+        if len(chunk) == 0:
+            return []
+        src, tgt, src_tag_txt, tgt_tag_txt = zip(*chunk)
+        isrc = split_chunk(self.voc_src.encode(list(chain.from_iterable(src))), src)
+        itgt = split_chunk(self.voc_tgt.encode(list(chain.from_iterable(tgt))), tgt)
+        src_tag = split_chunk(tags_array(src_tag_txt, src), src)
+        tgt_tag = split_chunk(tags_array(tgt_tag_txt, tgt), tgt)
+        return zip(isrc, itgt, src, tgt, src_tag, tgt_tag)
 
     def keep_records(self, src_tag, tgt_tag, isrc, itgt):
         self.ndiv_src += sum(1 for s in src_tag if s == 1.0)
@@ -273,68 +570,395 @@ class Dataset():
         self.ntgt += len(tgt_tag)
 
 
-def minibatches(data, minibatch_size):
-    SRC, TGT, RAW_SRC, RAW_TGT, SRC_TAG, TGT_TAG = [], [], [], [], [], []
+def count_lines(file):
+    """counts lines reading large blocks (no string is built per line)"""
+    if file.endswith('.gz'):
+        f = gzip.open(file, 'rb')
+    else:
+        f = open(file, 'rb')
+    nlines = 0
+    last = '\n'
+    block = f.read(1 << 20)
+    while block:
+        nlines += block.count('\n')
+        last = block[-1]
+        block = f.read(1 << 20)
+    f.close()
+    if last != '\n':
+        ### last line without newline
+        nlines += 1
+    return nlines
+
+
+### files of a binary corpus (.meta is written the last)
+binary_files = ['src.ids', 'tgt.ids', 'src.tags', 'tgt.tags', 'src.txt', 'tgt.txt', 'src.offs', 'tgt.offs',
+                'src.toffs', 'tgt.toffs', 'meta']
+binary_dtypes = {'ids': np.int32, 'tags': np.int8, 'txt': np.uint8, 'offs': np.int64, 'toffs': np.int64}
+
+
+def offsets(lens):
+    offs = np.zeros(len(lens)+1, dtype=np.int64)
+    offs[1:] = np.cumsum(np.array(lens, dtype=np.int64))
+    return offs
+
+
+def segment_counts(values, offs, value, block=100000):
+    """number of elements equal to value in each segment values[offs[i]:offs[i+1]] (computed by blocks of
+    segments, values may be memory-mapped)"""
+    counts = np.zeros(len(offs)-1, dtype=np.int32)
+    for b in range(0, len(counts), block):
+        e = min(b+block, len(counts))
+        cum = np.zeros(offs[e]-offs[b]+1, dtype=np.int64)
+        np.cumsum(values[offs[b]:offs[e]] == value, out=cum[1:])
+        counts[b:e] = cum[offs[b+1:e+1]-offs[b]] - cum[offs[b:e]-offs[b]]
+    return counts
+
+
+class EncodedExamples():
+    """examples appended to flat buffers, converted to the arrays of a binary corpus (see compile_dataset)"""
+
+    def __init__(self):
+        self.nexamples = 0
+        self.ids = {'src': array('i'), 'tgt': array('i')}
+        self.tags = {'src': array('b'), 'tgt': array('b')}
+        self.txt = {'src': [], 'tgt': []}
+        self.lens = {'src': array('l'), 'tgt': array('l')}
+        self.tlens = {'src': array('l'), 'tgt': array('l')}
+
+    def add(self, isrc, itgt, src, tgt, src_tag, tgt_tag):
+        for side, ids, words, tags in [('src', isrc, src, src_tag), ('tgt', itgt, tgt, tgt_tag)]:
+            txt = " ".join(words).encode('utf-8')
+            self.ids[side].extend(ids)
+            self.tags[side].extend(int(t) for t in tags)
+            self.txt[side].append(txt)
+            self.lens[side].append(len(ids))
+            self.tlens[side].append(len(txt))
+        self.nexamples += 1
+
+    def arrays(self):
+        arrays = {}
+        for side in ['src', 'tgt']:
+            arrays[side + '.ids'] = np.frombuffer(self.ids[side], dtype=np.int32)
+            arrays[side + '.tags'] = np.frombuffer(self.tags[side], dtype=np.int8)
+            arrays[side + '.txt'] = np.frombuffer(b"".join(self.txt[side]), dtype=np.uint8)
+            arrays[side + '.offs'] = offsets(self.lens[side])
+            arrays[side + '.toffs'] = offsets(self.tlens[side])
+        return arrays
+
+
+class Sentences():
+    """unique sentences of a monolingual file (one per line) mapped to the vocab of one side: words of unique sentence
+    u are ids[offs[u]:offs[u+1]] and line i contains unique sentence inverse[i]"""
+
+    def __init__(self, file, voc, tok=None, side="src", tok_workers=1):
+        if file.endswith('.gz'):
+            f = gzip.open(file, 'rb')
+        else:
+            f = open(file, 'rb')
+        index = {}
+        lines = []
+        inverse = array('l')
+        for line in f:
+            line = line.strip()
+            u = index.get(line)
+            if u is None:
+                u = index[line] = len(lines)
+                lines.append(line)
+            inverse.append(u)
+        f.close()
+        del index
+        self.nlines = len(inverse)
+        self.inverse = np.array(inverse, dtype=np.int64)
+        tokenizer = None
+        if tok is not None:
+            tokenizer = PairTokenizer(tok if side == "src" else None, tok if side == "tgt" else None, tok_workers)
+        col = 0 if side == "src" else 1
+        ids = array('i')
+        lens = array('l')
+        ### tokenization and vocab lookup by chunks of unique sentences
+        for ini in range(0, len(lines), 10000):
+            chunk = [[line, line] for line in lines[ini:ini+10000]]
+            if tokenizer is not None:
+                chunk = tokenizer.tokenize(chunk)
+            words = [lsplit[col].split(' ') if len(lsplit[col]) else [] for lsplit in chunk]
+            ids.extend(voc.encode(list(chain.from_iterable(words))).tolist())
+            lens.extend(len(w) for w in words)
+        if tokenizer is not None:
+            tokenizer.close()
+        self.ids = np.frombuffer(ids, dtype=np.int32)
+        self.lens = np.array(lens, dtype=np.int64)
+        self.offs = offsets(self.lens)
+        self.ntokens = len(self.ids)
+        self.nunk = int(np.count_nonzero(self.ids == idx_unk))
+
+    def __len__(self):
+        return len(self.lens)
+
+
+def file_digest(file):
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        block = f.read(1 << 20)
+        while block:
+            h.update(block)
+            block = f.read(1 << 20)
+    return h.hexdigest()
+
+
+def cache_prefix(cache, filepath, tok_src, tok_tgt, voc_src, voc_tgt, do_skip_empty):
+    """cached corpora are named after the content of data files, tokenization options and vocabularies"""
+    h = hashlib.sha1()
+    for file in filepath.split(","):
+        h.update(file_digest(file))
+    h.update(json.dumps([tok_src, tok_tgt, do_skip_empty], sort_keys=True))
+    h.update(voc_src.digest())
+    h.update(voc_tgt.digest())
+    return os.path.join(cache, h.hexdigest())
+
+
+def open_memmap(file, dtype):
+    if os.path.getsize(file) == 0:
+        ### np.memmap cannot map empty files
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file, dtype=dtype, mode='r')
+
+
+def compile_dataset(data, prefix):
+    """writes examples of data (a text Dataset) into flat binary arrays: token ids (int32), tags (int8) and
+    per-sentence offsets (int64), plus the tokenized sentences (needed to output raw words)"""
+    fhs = {}
+    for side in ['src', 'tgt']:
+        for ext in ['ids', 'tags', 'txt']:
+            fhs[side + '.' + ext] = open('{}.{}.{}'.format(prefix, side, ext), 'wb')
+    len_src, len_tgt, tlen_src, tlen_tgt = array('l'), array('l'), array('l'), array('l')
+    for isrc, itgt, src, tgt, src_tag, tgt_tag in data:
+        np.asarray(isrc, dtype=np.int32).tofile(fhs['src.ids'])
+        np.asarray(itgt, dtype=np.int32).tofile(fhs['tgt.ids'])
+        np.asarray(src_tag, dtype=np.int8).tofile(fhs['src.tags'])
+        np.asarray(tgt_tag, dtype=np.int8).tofile(fhs['tgt.tags'])
+        txt_src = " ".join(src).encode('utf-8')
+        txt_tgt = " ".join(tgt).encode('utf-8')
+        fhs['src.txt'].write(txt_src)
+        fhs['tgt.txt'].write(txt_tgt)
+        len_src.append(len(isrc))
+        len_tgt.append(len(itgt))
+        tlen_src.append(len(txt_src))
+        tlen_tgt.append(len(txt_tgt))
+    for fh in fhs.values():
+        fh.close()
+    for ext, lens in [('src.offs', len_src), ('tgt.offs', len_tgt), ('src.toffs', tlen_src), ('tgt.toffs', tlen_tgt)]:
+        offsets(lens).tofile('{}.{}'.format(prefix, ext))
+    ### written last, it flags the binary corpus as complete
+    with open(prefix + '.meta', 'w') as f:
+        f.write("examples {}\n".format(len(len_src)))
+        f.write("annotated {}\n".format(1 if data.annotated else 0))
+        f.write("src_voc_size {}\n".format(len(data.voc_src)))
+        f.write("tgt_voc_size {}\n".format(len(data.voc_tgt)))
+    sys.stderr.write('Compiled {} examples into {} (words={}/{})\n'.format(
+        len(len_src), prefix, sum(len_src), sum(len_tgt)))
+
+
+class Padding():
+    """keeps record of real cells vs padded cells (real+padding) of src/tgt/align batches"""
+
+    def __init__(self):
+        self.nsrc, self.ntgt, self.nalign = 0, 0, 0
+        self.psrc, self.ptgt, self.palign = 0, 0, 0
+
+    def add(self, SRC, TGT, max_src, max_tgt):
+        for src, tgt in zip(SRC, TGT):
+            self.nsrc += len(src)
+            self.ntgt += len(tgt)
+            self.nalign += len(src) * len(tgt)
+        self.psrc += len(SRC) * max_src
+        self.ptgt += len(TGT) * max_tgt
+        self.palign += len(SRC) * max_src * max_tgt
+
+    def efficiency(self):
+        ### percentage of real cells over src, tgt and align padded batches
+        eff_src, eff_tgt, eff_align = 0.0, 0.0, 0.0
+        if self.psrc > 0:
+            eff_src = 100.0 * self.nsrc / self.psrc
+        if self.ptgt > 0:
+            eff_tgt = 100.0 * self.ntgt / self.ptgt
+        if self.palign > 0:
+            eff_align = 100.0 * self.nalign / self.palign
+        return eff_src, eff_tgt, eff_align
+
+
+def consecutive_groups(data, minibatch_size):
+    examples = []
+    for example in data:
+        examples.append(example)
+        if len(examples) == minibatch_size:
+            yield examples
+            examples = []
+    if len(examples) != 0:
+        yield examples
+
+
+def batch_cost(size, max_src, max_tgt, align):
+    ### cells of padded src/tgt batches (plus alignment matrices)
+    cost = size * (max_src + max_tgt)
+    if align:
+        cost += size * max_src * max_tgt
+    return cost
+
+
+def token_groups(data, batch_tokens, align):
+    """groups of examples with padded cost (see batch_cost) up to batch_tokens"""
+    examples = []
     max_src, max_tgt = 0, 0
-    for (src, tgt, raw_src, raw_tgt, src_tag, tgt_tag) in data:
-        if len(SRC) == minibatch_size:
-            yield build_batch(SRC, TGT, RAW_SRC, RAW_TGT, SRC_TAG, TGT_TAG, max_src, max_tgt)
-            SRC, TGT, RAW_SRC, RAW_TGT, SRC_TAG, TGT_TAG = [], [], [], [], [], []
-            max_src, max_tgt = 0, 0
-        if len(src) > max_src:
-            max_src = len(src)
-        if len(tgt) > max_tgt:
-            max_tgt = len(tgt)
-        SRC.append(src)
-        TGT.append(tgt)
-        RAW_SRC.append(raw_src)
-        RAW_TGT.append(raw_tgt)
-        SRC_TAG.append(src_tag)
-        TGT_TAG.append(tgt_tag)
-
-    if len(SRC) != 0:
-        yield build_batch(SRC, TGT, RAW_SRC, RAW_TGT, SRC_TAG, TGT_TAG, max_src, max_tgt)
-
-
-def build_batch(SRC, TGT, RAW_SRC, RAW_TGT, SRC_TAG, TGT_TAG, max_src, max_tgt):
-    src_batch, tgt_batch, raw_src_batch, raw_tgt_batch, sign_src_batch, sign_tgt_batch = [], [], [], [], [], []
-    sign_batch, len_src_batch, len_tgt_batch = [], [], []
-    ### build: src_batch, pad_src_batch sized of max_src
+    for example in data:
+        src_len = max(max_src, len(example[0]))
+        tgt_len = max(max_tgt, len(example[1]))
+        if len(examples) and batch_cost(len(examples)+1, src_len, tgt_len, align) > batch_tokens:
+            yield examples
+            examples = []
+            src_len, tgt_len = len(example[0]), len(example[1])
+        examples.append(example)
+        max_src, max_tgt = src_len, tgt_len
+    if len(examples) != 0:
+        yield examples
+
+
+def batch_groups(data, minibatch_size, batch_tokens, align):
+    if batch_tokens > 0:
+        return token_groups(data, batch_tokens, align)
+    return consecutive_groups(data, minibatch_size)
+
+
+def bucket_groups(data, minibatch_size, bucket, batch_tokens, align):
+    """examples are sorted by length within pools of bucket x minibatch_size examples, batches of each pool are
+    output shuffled"""
+    for pool in consecutive_groups(data, minibatch_size * bucket):
+        ### data is already shuffled, the (stable) sort keeps examples of same lengths in random order
+        pool.sort(key=lambda e: (len(e[0]), len(e[1])))
+        groups = list(batch_groups(pool, minibatch_size, batch_tokens, align))
+        shuffle(groups)
+        for examples in groups:
+            yield examples
+
+
+def minibatches(data, minibatch_size, bucket=0, padding=None, batch_tokens=0, align=True, buffers=None):
+    """batches of minibatch_size examples, or of up to batch_tokens padded cells if batch_tokens > 0"""
+    if bucket > 0:
+        groups = bucket_groups(data, minibatch_size, bucket, batch_tokens, align)
+    else:
+        groups = batch_groups(data, minibatch_size, batch_tokens, align)
+    for examples in groups:
+        SRC, TGT, RAW_SRC, RAW_TGT, SRC_TAG, TGT_TAG = [list(x) for x in zip(*examples)]
+        max_src = max(len(src) for src in SRC)
+        max_tgt = max(len(tgt) for tgt in TGT)
+        if padding is not None:
+            padding.add(SRC, TGT, max_src, max_tgt)
+        yield build_batch(SRC, TGT, RAW_SRC, RAW_TGT, SRC_TAG, TGT_TAG, max_src, max_tgt, buffers)
+
+
+class Buffers():
+    """preallocated batch arrays, cycling over nslots sets of arrays so that a batch is not overwritten while
+    still in use"""
+
+    def __init__(self, nslots=1):
+        self.slots = [{} for _ in range(nslots)]
+        self.curr = -1
+
+    def next(self):
+        self.curr = (self.curr + 1) % len(self.slots)
+
+    def get(self, name, rows, cols, dtype):
+        slot = self.slots[self.curr]
+        size = rows * cols
+        if name not in slot or slot[name].size < size:
+            old = slot[name].size if name in slot else 0
+            slot[name] = np.empty(max(size, 2 * old), dtype=dtype)
+        ### contiguous view (no copy when fed to tensorflow)
+        return slot[name][:size].reshape(rows, cols)
+
+
+class Prefetcher():
+    """builds batches in a background thread, up to depth batches ahead of the one being consumed"""
+
+    def __init__(self, batches, depth):
+        self.queue = queue.Queue(maxsize=depth)
+        self.end = object()
+        ### batches consumed, times the consumer waited for an empty queue, times the producer waited for a full one
+        self.nbatches = 0
+        self.nstarved = 0
+        self.nfull = 0
+        ### sum of queue depths seen by the consumer (average depth is depth_sum/nbatches)
+        self.depth_sum = 0
+        self.thread = threading.Thread(target=self.produce, args=(batches,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self, batches):
+        try:
+            for batch in batches:
+                if self.queue.full():
+                    self.nfull += 1
+                self.queue.put((batch, None))
+        except Exception:
+            ### raised again by the consumer
+            self.queue.put((None, sys.exc_info()))
+            return
+        self.queue.put((self.end, None))
+
+    def __iter__(self):
+        while True:
+            depth = self.queue.qsize()
+            if depth == 0:
+                self.nstarved += 1
+            batch, error = self.queue.get()
+            if error is not None:
+                six.reraise(*error)
+            if batch is self.end:
+                break
+            self.depth_sum += depth
+            self.nbatches += 1
+            yield batch
+
+    def stats(self):
+        depth = 0.0
+        if self.nbatches > 0:
+            depth = 1.0 * self.depth_sum / self.nbatches
+        return 'prefetch: depth={:.2f} starved={}/{} full={}'.format(depth, self.nstarved, self.nbatches, self.nfull)
+
+
+def padded_array(name, rows, cols, dtype, buffers):
+    if buffers is None:
+        return np.empty((rows, cols), dtype=dtype)
+    return buffers.get(name, rows, cols, dtype)
+
+
+def build_batch(SRC, TGT, RAW_SRC, RAW_TGT, SRC_TAG, TGT_TAG, max_src, max_tgt, buffers=None):
     batch_size = len(SRC)
-    for i in range(batch_size):
-        # add padding to have max_src/max_tgt words in all examples of current batch
-        sign_src = SRC_TAG[i]
-        sign_tgt = TGT_TAG[i]
-        ### sign is divergent (+1) if there is any divergent word
-        sign = max(max(sign_src), max(sign_tgt))
-        while len(sign_src) < max_src:
-            ### continue filling up to max_tgt cells
-            sign_src.append(-1.0)
-        while len(sign_tgt) < max_tgt:
-            ### continue filling up to max_tgt cells
-            sign_tgt.append(-1.0)
-        src = list(SRC[i])
-        tgt = list(TGT[i])
-        while len(src) < max_src:
-            # <pad>
-            src.append(idx_pad)
-        while len(tgt) < max_tgt:
-            # <pad>
-            tgt.append(idx_pad)
-        raw_src = list(RAW_SRC[i])
-        raw_tgt = list(RAW_TGT[i])
-        len_src = len(SRC[i])
-        len_tgt = len(TGT[i])
-        ### add to batches
-        sign_src_batch.append(sign_src)
-        sign_tgt_batch.append(sign_tgt)
-        sign_batch.append(sign)
-        src_batch.append(src)
-        tgt_batch.append(tgt)
-        raw_src_batch.append(raw_src)
-        raw_tgt_batch.append(raw_tgt)
-        len_src_batch.append(len_src)
-        len_tgt_batch.append(len_tgt)
-
-    return src_batch, tgt_batch, raw_src_batch, raw_tgt_batch, sign_src_batch, sign_tgt_batch, sign_batch, \
+    len_src_batch = np.fromiter((len(src) for src in SRC), dtype=np.int32, count=batch_size)
+    len_tgt_batch = np.fromiter((len(tgt) for tgt in TGT), dtype=np.int32, count=batch_size)
+    ### cells of real words (the others are padding)
+    mask_src = np.arange(max_src) < len_src_batch[:, None]
+    mask_tgt = np.arange(max_tgt) < len_tgt_batch[:, None]
+    nsrc = int(len_src_batch.sum())
+    ntgt = int(len_tgt_batch.sum())
+    if buffers is not None:
+        buffers.next()
+
+    ### build: src_batch, tgt_batch sized of max_src/max_tgt, filled up with <pad>
+    src_batch = padded_array('src', batch_size, max_src, np.int32, buffers)
+    src_batch.fill(idx_pad)
+    src_batch[mask_src] = np.fromiter(chain.from_iterable(SRC), dtype=np.int32, count=nsrc)
+    tgt_batch = padded_array('tgt', batch_size, max_tgt, np.int32, buffers)
+    tgt_batch.fill(idx_pad)
+    tgt_batch[mask_tgt] = np.fromiter(chain.from_iterable(TGT), dtype=np.int32, count=ntgt)
+    ### sign_src_batch, sign_tgt_batch filled up with -1.0
+    sign_src_batch = padded_array('sign_src', batch_size, max_src, np.float32, buffers)
+    sign_src_batch.fill(-1.0)
+    sign_src_batch[mask_src] = np.fromiter(chain.from_iterable(SRC_TAG), dtype=np.float32, count=nsrc)
+    sign_tgt_batch = padded_array('sign_tgt', batch_size, max_tgt, np.float32, buffers)
+    sign_tgt_batch.fill(-1.0)
+    sign_tgt_batch[mask_tgt] = np.fromiter(chain.from_iterable(TGT_TAG), dtype=np.float32, count=ntgt)
+    ### sign is divergent (+1) if there is any divergent word
+    sign_batch = np.maximum(sign_src_batch.max(axis=1), sign_tgt_batch.max(axis=1))
+
+    return src_batch, tgt_batch, RAW_SRC, RAW_TGT, sign_src_batch, sign_tgt_batch, sign_batch, \
         len_src_batch, len_tgt_batch
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from dataset import minibatches, Buffers, Prefetcher, Sentences, offsets, idx_pad
+from visualize import Visualize
+from monitor import Monitor
+from score import Score
+from mining import inverse_file
+
+
+def batches(config, data, bucket=0, padding=None):
+    """minibatches of data as set by config (-batch_size, -batch_tokens, -prefetch)"""
+    if config.prefetch == 0:
+        ### each batch is consumed before the next one is built, a single set of arrays is reused
+        return minibatches(data, config.batch_size, bucket, padding, config.batch_tokens,
+                           align=config.mode == "alignment", buffers=Buffers(nslots=1))
+    ### arrays in use: prefetched batches plus the one being built and the one being consumed
+    buffers = Buffers(nslots=config.prefetch+2)
+    return Prefetcher(minibatches(data, config.batch_size, bucket, padding, config.batch_tokens,
+                                  align=config.mode == "alignment", buffers=buffers), config.prefetch)
+
+
+def output_names(config, annotated, quiet):
+    """names of the outputs needed by the output flags (sim, align, aggr_src/tgt, last_src/tgt), the alignment
+    matrix is not computed when only the similarity score is needed"""
+    show_matrix = config.show_svg or config.show_matrix
+    names = ['sim']
+    if config.mode != "sentence":
+        if show_matrix or (config.show_align and not quiet):
+            names.append('align')
+        if annotated or show_matrix or (config.show_aggr and not quiet):
+            names += ['aggr_src', 'aggr_tgt']
+    if config.show_last and not quiet:
+        names += ['last_src', 'last_tgt']
+    return names
+
+
+### outputs computed by the second stage of -cascade
+stage2_names = ['align', 'aggr_src', 'aggr_tgt']
+
+
+def cascade_band(config):
+    """(low, high) of -cascade"""
+    return tuple(map(float, config.cascade.split(':')))
+
+
+def cascade(out, names, len_src, len_tgt, low, high, run_stage2):
+    """second stage of -cascade: names (out of stage2_names) are computed by run_stage2(rows) only for the pairs with
+    low < sim < high (out['stage2']), words of the other pairs are predicted from sim: aligned (+1.0) when sim >= high,
+    divergent (-1.0) when sim <= low. Padded widths are kept so that outputs do not depend on the cascade"""
+    sim = out['sim']
+    band = (sim > low) & (sim < high)
+    out['stage2'] = band
+    rows = np.flatnonzero(band)
+    S = int(np.max(len_src)) if len(len_src) else 0
+    T = int(np.max(len_tgt)) if len(len_tgt) else 0
+    decision = np.where(sim >= high, 1.0, -1.0).astype(np.float32)
+    if 'aggr_src' in names:
+        out['aggr_src'] = np.repeat(decision[:, None], S, axis=1)
+        out['aggr_tgt'] = np.repeat(decision[:, None], T, axis=1)
+    if 'align' in names:
+        out['align'] = np.zeros((len(sim), S, T), dtype=np.float32)
+    if len(rows):
+        out2 = run_stage2(rows)
+        for name in stage2_names:
+            if name in names:
+                out[name][rows] = out2[name]
+    return out
+
+
+def inference(config, tst, output, run, stats=None, quiet=False):
+    """writes the outputs of every pair of tst, run(batch, monitor) returns a dict with the outputs (see output_names)
+    of the batch, scores are reported when tst is annotated"""
+    if config.show_svg:
+        output.write("<html>\n<body>\n")
+    score = Score()
+    n_sents = 0
+    n_stage2 = 0
+    monitor = Monitor('test', stats)
+    for iter, batch in enumerate(batches(config, tst)):
+        (src_batch, tgt_batch, raw_src_batch, raw_tgt_batch, sign_src_batch, sign_tgt_batch, sign_batch,
+         len_src_batch, len_tgt_batch) = batch
+        monitor.lap('batch')
+        monitor.add_batch(len_src_batch, len_tgt_batch, src_batch.shape[1], tgt_batch.shape[1])
+        out = run(batch, monitor)
+        monitor.lap('run')
+        sim_batch = out['sim']
+
+        if config.mode == "sentence":
+            if tst.annotated:
+                score.add_batch(sim_batch, sign_batch)
+            monitor.lap('score')
+            for i_sent in range(len(sim_batch)):
+                n_sents += 1
+                v = Visualize(output, n_sents, raw_src_batch[i_sent], raw_tgt_batch[i_sent], sim_batch[i_sent])
+                last_src = []
+                last_tgt = []
+                if 'last_src' in out:
+                    last_src = out['last_src'][i_sent]
+                    last_tgt = out['last_tgt'][i_sent]
+                v.print_vectors(last_src, last_tgt, aggr_src=[], aggr_tgt=[], align=[], quiet=quiet)
+        else:
+            if tst.annotated:
+                score.add_batch_tokens(out['aggr_src'], sign_src_batch, len_src_batch)
+                score.add_batch_tokens(out['aggr_tgt'], sign_tgt_batch, len_tgt_batch)
+            if 'stage2' in out:
+                n_stage2 += int(np.count_nonzero(out['stage2']))
+            monitor.lap('score')
+            for i_sent in range(len(sim_batch)):
+                n_sents += 1
+                ### pairs decided by the first stage of -cascade have no align/aggr outputs
+                stage2 = 'stage2' not in out or out['stage2'][i_sent]
+                v = Visualize(output, n_sents, raw_src_batch[i_sent], raw_tgt_batch[i_sent], sim_batch[i_sent])
+                if config.show_svg:
+                    v.print_svg(out['aggr_src'][i_sent], out['aggr_tgt'][i_sent], out['align'][i_sent])
+                elif config.show_matrix:
+                    v.print_matrix(out['aggr_src'][i_sent], out['aggr_tgt'][i_sent], out['align'][i_sent])
+                else:
+                    last_src = []
+                    last_tgt = []
+                    aggr_src = []
+                    aggr_tgt = []
+                    align = []
+                    if 'last_src' in out:
+                        last_src = out['last_src'][i_sent]
+                        last_tgt = out['last_tgt'][i_sent]
+                    if config.show_aggr and 'aggr_src' in out and stage2:
+                        aggr_src = out['aggr_src'][i_sent]
+                        aggr_tgt = out['aggr_tgt'][i_sent]
+                    if 'align' in out and stage2:
+                        align = out['align'][i_sent]
+                    v.print_vectors(last_src, last_tgt, aggr_src, aggr_tgt, align, quiet=quiet)
+        monitor.lap('output')
+
+    if tst.annotated:
+        score.update()
+        unk_s = float(100) * tst.nunk_src / tst.nsrc
+        unk_t = float(100) * tst.nunk_tgt / tst.ntgt
+        div_s = float(100) * tst.ndiv_src / tst.nsrc
+        div_t = float(100) * tst.ndiv_tgt / tst.ntgt
+        sys.stderr.write('TEST words={}/{} %div={:.2f}/{:.2f} %unk={:.2f}/{:.2f} (A{:.4f},P{:.4f},R{:.4f},F{:.4f})'
+                         ' (TP:{},TN:{},FP:{},FN:{})\n'.format(
+                                tst.nsrc, tst.ntgt, div_s, div_t, unk_s, unk_t, score.A, score.P, score.R, score.F,
+                                score.TP, score.TN, score.FP, score.FN))
+    sys.stderr.write('TEST {}\n'.format(monitor.line(window=False)))
+    if config.cascade is not None:
+        ### pairs run by each stage (all pairs run the first one)
+        sys.stderr.write('CASCADE {} pairs={} stage1={} (100.00%) stage2={} ({:.2f}%)\n'.format(
+            config.cascade, n_sents, n_sents, n_stage2, 100.0 * n_stage2 / max(n_sents, 1)))
+        monitor.record(kind='test', cascade={'band': config.cascade, 'stage1': n_sents, 'stage2': n_stage2})
+    else:
+        monitor.record(kind='test')
+
+    if config.show_svg:
+        output.write("</body>\n</html>\n")
+
+
+def sentences(config):
+    """unique sentences of -encode mapped to the vocab of -side"""
+    if config.side == "src":
+        return Sentences(config.encode, config.voc_src, config.tok_src, "src", config.tok_workers)
+    return Sentences(config.encode, config.voc_tgt, config.tok_tgt, "tgt", config.tok_workers)
+
+
+def encode_batches(config, lens):
+    """batches of sentences (indexs) sorted by length (less padding), of -batch_size sentences or -batch_tokens cells"""
+    order = np.argsort(lens, kind='mergesort')
+    ini = 0
+    while ini < len(order):
+        end = min(ini + config.batch_size, len(order))
+        if config.batch_tokens > 0:
+            end = ini + 1
+            while end < len(order) and (end + 1 - ini) * lens[order[end]] <= config.batch_tokens:
+                end += 1
+        yield order[ini:end]
+        ini = end
+
+
+def encode(config, sents, output, run, stats=None):
+    """writes the vectors of all lines of sents (see dataset.Sentences) in output (.npy, one row per line, float16 with
+    -fp16), each unique sentence is encoded once, run(input, lengths) returns the vectors of a batch. The unique
+    sentence of every line is written in inverse_file(output) (used by mining.py)"""
+    dim = 2 * (config.src_lstm_size if config.side == "src" else config.tgt_lstm_size)
+    dtype = np.float16 if config.fp16 else np.float32
+    np.save(inverse_file(output), sents.inverse)
+    if sents.nlines == 0:
+        np.save(output, np.zeros((0, dim), dtype=dtype))
+        return
+    vectors = np.lib.format.open_memmap(output, mode='w+', dtype=dtype, shape=(sents.nlines, dim))
+    ### lines of unique sentence u are lines[first[u]:first[u+1]]
+    lines = np.argsort(sents.inverse, kind='mergesort')
+    counts = np.bincount(sents.inverse, minlength=len(sents))
+    first = offsets(counts)
+    monitor = Monitor('encode', stats)
+    for batch in encode_batches(config, sents.lens):
+        lens = sents.lens[batch]
+        input = np.full((len(batch), max(int(lens.max()), 1)), idx_pad, dtype=np.int32)
+        input[np.arange(input.shape[1]) < lens[:, None]] = np.concatenate(
+            [sents.ids[sents.offs[u]:sents.offs[u+1]] for u in batch])
+        monitor.lap('batch')
+        monitor.add_batch(lens, lens[:0], input.shape[1], 0)
+        out = run(input, lens)
+        monitor.lap('run')
+        rows = np.concatenate([lines[first[u]:first[u+1]] for u in batch])
+        vectors[rows] = np.repeat(out, counts[batch], axis=0)
+        monitor.lap('output')
+    vectors.flush()
+    del vectors
+    unk = 100.0 * sents.nunk / max(sents.ntokens, 1)
+    sys.stderr.write('ENCODE lines={} unique={} words={} %unk={:.2f} {}\n'.format(
+        sents.nlines, len(sents), sents.ntokens, unk, monitor.line(window=False)))
+    monitor.record(kind='encode', lines=sents.nlines, unique=len(sents))
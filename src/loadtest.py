@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import socket
+import threading
+from six.moves import http_client
+from server import parse_address, percentiles
+
+
+class options():
+
+    def __init__(self, argv):
+        self.address = None
+        self.tst = None
+        self.clients = 8
+        self.requests = 100
+        self.pairs = 1
+        usage = """usage: {}
+*  -address    ADDRESS : address of a server (similarity.py -serve ADDRESS): HOST:PORT or unix:PATH
+*  -tst           FILE : pairs sent to the server (src tab tgt, other columns are not sent)
+   -clients        INT : number of concurrent clients [8]
+   -requests       INT : number of requests sent by each client [100]
+   -pairs          INT : number of pairs per request [1]
+   -h                  : this help
+
+- Every client sends its requests one after the other (the next one when the previous one is answered), pairs of
+  -tst are sent in a round-robin way. Latency percentiles (ms) and throughput seen by clients are printed, followed
+  by the stats of the server (GET /stats).
+""".format(argv.pop(0))
+
+        while len(argv):
+            tok = argv.pop(0)
+            if (tok == "-address" and len(argv)):
+                self.address = argv.pop(0)
+            elif (tok == "-tst" and len(argv)):
+                self.tst = argv.pop(0)
+            elif (tok == "-clients" and len(argv)):
+                self.clients = int(argv.pop(0))
+            elif (tok == "-requests" and len(argv)):
+                self.requests = int(argv.pop(0))
+            elif (tok == "-pairs" and len(argv)):
+                self.pairs = int(argv.pop(0))
+            elif (tok == "-h"):
+                sys.stderr.write("{}".format(usage))
+                sys.exit()
+            else:
+                sys.stderr.write('error: unparsed {} option\n'.format(tok))
+                sys.stderr.write("{}".format(usage))
+                sys.exit(1)
+
+        if self.address is None or self.tst is None:
+            sys.stderr.write('error: missing -address or -tst option\n{}'.format(usage))
+            sys.exit(1)
+        if parse_address(self.address) is None:
+            sys.stderr.write('error: bad -address {} (use HOST:PORT or unix:PATH)\n'.format(self.address))
+            sys.exit(1)
+
+
+class UnixConnection(http_client.HTTPConnection):
+    """http over a unix socket"""
+
+    def __init__(self, path):
+        http_client.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def connection(address):
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        return http_client.HTTPConnection(*address)
+    return UnixConnection(address)
+
+
+def request(conn, method, path, body=None):
+    conn.request(method, path, body)
+    response = conn.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise IOError('{} {} failed ({}): {}'.format(method, path, response.status, data.strip()))
+    return data
+
+
+def client(o, lines, first, latencies, errors):
+    ### a keep-alive connection per client
+    conn = connection(o.address)
+    try:
+        for i in range(o.requests):
+            ini = (first + i * o.pairs) % len(lines)
+            body = '\n'.join(lines[(ini + j) % len(lines)] for j in range(o.pairs)) + '\n'
+            start = time.time()
+            scores = request(conn, 'POST', '/score', body).splitlines()
+            latencies.append(time.time() - start)
+            if len(scores) != o.pairs:
+                raise IOError('{} scores received for {} pairs'.format(len(scores), o.pairs))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        conn.close()
+
+
+def main(args):
+    o = options(args)
+    lines = []
+    with open(o.tst, 'rb') as f:
+        for line in f:
+            lsplit = line.rstrip('\n').split('\t')
+            if len(lsplit) >= 2:
+                lines.append('\t'.join(lsplit[:2]))
+    if len(lines) == 0:
+        sys.stderr.write('error: no pairs in {}\n'.format(o.tst))
+        sys.exit(1)
+
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=client, args=(o, lines, c * o.requests * o.pairs, latencies, errors))
+               for c in range(o.clients)]
+    ini = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    secs = max(time.time() - ini, 1e-6)
+    if errors:
+        sys.stderr.write('error: {} clients failed: {}\n'.format(len(errors), errors[0]))
+        sys.exit(1)
+
+    p = percentiles(latencies)
+    print("clients={} requests={} pairs/request={} time(s)={:.2f} requests/s={:.1f} pairs/s={:.1f}".format(
+        o.clients, len(latencies), o.pairs, secs, len(latencies) / secs, len(latencies) * o.pairs / secs))
+    print("latency(ms): p50={:.2f} p90={:.2f} p99={:.2f} max={:.2f}".format(p['p50'], p['p90'], p['p99'], p['max']))
+    conn = connection(o.address)
+    print("server: {}".format(json.dumps(json.loads(request(conn, 'GET', '/stats')), sort_keys=True)))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
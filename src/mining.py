@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import numpy as np
+
+
+class options():
+
+    def __init__(self, argv):
+        self.src = None
+        self.tgt = None
+        self.src_txt = None
+        self.tgt_txt = None
+        self.k = 4
+        self.block = 4096
+        self.margin = 'ratio'
+        self.threshold = None
+        self.output = '-'
+        usage = """usage: {}
+*  -src           FILE : src sentence vectors (.npy written by similarity.py -encode FILE -side src)
+*  -tgt           FILE : tgt sentence vectors (.npy written by similarity.py -encode FILE -side tgt)
+   -src_txt       FILE : src sentences (the file encoded into -src), output with mined pairs
+   -tgt_txt       FILE : tgt sentences (the file encoded into -tgt), output with mined pairs
+   -k              INT : number of nearest neighbours (candidates of each src sentence, and neighbourhood size
+                         used by margin scores) [4]
+   -block          INT : vectors are compared by blocks of this many src x tgt sentences [4096]
+   -margin      STRING : score of candidates: cosine, ratio (cosine divided by the mean cosine of the neighbourhoods
+                         of both sentences) or distance (cosine minus that mean) [ratio]
+   -threshold    FLOAT : output pairs with a score over this value (all by default)
+   -output        FILE : output file [- by default is STDOUT]
+   -h                  : this help
+
+- Every src sentence is paired with its best scoring tgt candidate (out of its k nearest neighbours), pairs are
+  output by decreasing score: score, src line, tgt line (numbered from 1), and src/tgt sentences if given.
+- Duplicated sentences are mined once (the first of their lines is output) when the line to sentence map written
+  by -encode (FILE.inverse.npy next to FILE.npy) is found, otherwise every vector is considered a distinct sentence.
+- Search is exact (every src/tgt cosine is computed), memory used is bounded by -block and -k.
+- Margin scores (Artetxe and Schwenk, 2019) https://arxiv.org/abs/1811.01136
+""".format(argv.pop(0))
+
+        while len(argv):
+            tok = argv.pop(0)
+            if (tok == "-src" and len(argv)):
+                self.src = argv.pop(0)
+            elif (tok == "-tgt" and len(argv)):
+                self.tgt = argv.pop(0)
+            elif (tok == "-src_txt" and len(argv)):
+                self.src_txt = argv.pop(0)
+            elif (tok == "-tgt_txt" and len(argv)):
+                self.tgt_txt = argv.pop(0)
+            elif (tok == "-k" and len(argv)):
+                self.k = int(argv.pop(0))
+            elif (tok == "-block" and len(argv)):
+                self.block = int(argv.pop(0))
+            elif (tok == "-margin" and len(argv)):
+                self.margin = argv.pop(0)
+                if self.margin not in ['cosine', 'ratio', 'distance']:
+                    sys.stderr.write('error: bad -margin option \'{}\' (use cosine, ratio or distance)\n'.format(
+                        self.margin))
+                    sys.exit(1)
+            elif (tok == "-threshold" and len(argv)):
+                self.threshold = float(argv.pop(0))
+            elif (tok == "-output" and len(argv)):
+                self.output = argv.pop(0)
+            elif (tok == "-h"):
+                sys.stderr.write("{}".format(usage))
+                sys.exit()
+            else:
+                sys.stderr.write('error: unparsed {} option\n'.format(tok))
+                sys.stderr.write("{}".format(usage))
+                sys.exit(1)
+
+        if self.src is None or self.tgt is None:
+            sys.stderr.write('error: missing -src or -tgt option\n{}'.format(usage))
+            sys.exit(1)
+        if self.k < 1 or self.block < 1:
+            sys.stderr.write('error: -k and -block must be positive\n')
+            sys.exit(1)
+
+
+def inverse_file(file):
+    """line to unique sentence map written by -encode next to its vectors"""
+    return (file[:-4] if file.endswith('.npy') else file) + '.inverse.npy'
+
+
+class Rows():
+    """rows of a (memory-mapped) matrix, read by slices (as the matrix itself)"""
+
+    def __init__(self, x, rows):
+        self.x = x
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, s):
+        return self.x[self.rows[s]]
+
+
+def unique_rows(file, x):
+    """rows of x to mine: the first line of every unique sentence, all rows when the inverse map of file is not
+    found"""
+    inverse = inverse_file(file)
+    if not os.path.exists(inverse):
+        return np.arange(len(x))
+    inverse = np.load(inverse)
+    if len(inverse) != len(x):
+        sys.stderr.write('error: {} has {} lines, vectors are {}\n'.format(inverse_file(file), len(inverse), len(x)))
+        sys.exit(1)
+    _, first = np.unique(inverse, return_index=True)
+    return first
+
+
+def norms(x, block=4096):
+    """l2 norms of the rows of x (computed by blocks, x may be memory-mapped and float16)"""
+    n = np.zeros(len(x), dtype=np.float32)
+    for i in range(0, len(x), block):
+        xb = np.asarray(x[i:i+block], dtype=np.float32)
+        n[i:i+block] = np.sqrt(np.maximum(np.sum(xb * xb, axis=1), 1e-12))
+    return n
+
+
+def merge_topk(best_s, best_i, scores, indexs, k):
+    """k best candidates of every row out of the current best ones and new ones (rows are not sorted)"""
+    cand_s = np.concatenate([best_s, scores], axis=1)
+    cand_i = np.concatenate([best_i, indexs], axis=1)
+    if cand_s.shape[1] <= k:
+        return cand_s, cand_i
+    keep = np.argpartition(-cand_s, k-1, axis=1)[:, :k]
+    rows = np.arange(len(cand_s))[:, None]
+    return cand_s[rows, keep], cand_i[rows, keep]
+
+
+def sort_topk(best_s, best_i):
+    """candidates of every row by decreasing score"""
+    order = np.argsort(-best_s, axis=1, kind='mergesort')
+    rows = np.arange(len(best_s))[:, None]
+    return best_s[rows, order], best_i[rows, order]
+
+
+def knn(x, y, k, block=4096):
+    """exact k nearest neighbours (cosine) in y of every row of x: scores and indexs (len(x) x k, by decreasing
+    score). Cosines are computed by blocks of block x block rows, the best k of every row of x are kept by merging
+    them with the best k cosines of every new block (partial sorts)"""
+    k = min(k, len(y))
+    nx = norms(x, block)
+    ny = norms(y, block)
+    scores = np.zeros((len(x), k), dtype=np.float32)
+    indexs = np.zeros((len(x), k), dtype=np.int64)
+    for i in range(0, len(x), block):
+        xb = np.asarray(x[i:i+block], dtype=np.float32) / nx[i:i+block, None]
+        best_s = np.zeros((len(xb), 0), dtype=np.float32)
+        best_i = np.zeros((len(xb), 0), dtype=np.int64)
+        rows = np.arange(len(xb))[:, None]
+        for j in range(0, len(y), block):
+            yb = np.asarray(y[j:j+block], dtype=np.float32) / ny[j:j+block, None]
+            sims = np.dot(xb, yb.T)
+            if sims.shape[1] > k:
+                ### only the k best columns of the block are merged
+                top = np.argpartition(sims, -k, axis=1)[:, -k:]
+                sims = sims[rows, top]
+            else:
+                top = np.broadcast_to(np.arange(len(yb)), sims.shape)
+            best_s, best_i = merge_topk(best_s, best_i, sims, top + j, k)
+        scores[i:i+len(xb)], indexs[i:i+len(xb)] = sort_topk(best_s, best_i)
+    return scores, indexs
+
+
+def margin_scores(scores, indexs, x_mean, y_mean, margin):
+    """margin of candidates indexs (in y) of every x with cosines scores, x_mean and y_mean are the mean cosines of
+    the k nearest neighbours of every x (in y) and of every y (in x)"""
+    mean = (x_mean[:, None] + y_mean[indexs]) / 2.0
+    if margin == 'ratio':
+        ### a mean <= 0 would flip the sign of the ratio
+        nonpositive = int(np.count_nonzero(mean <= 0))
+        if nonpositive:
+            sys.stderr.write('warning: {} candidates have neighbourhoods with a mean cosine <= 0 (clamped to 1e-6), '
+                             'use -margin distance for these vectors\n'.format(nonpositive))
+        return scores / np.maximum(mean, 1e-6)
+    return scores - mean
+
+
+def mine(x, y, k=4, block=4096, margin='ratio'):
+    """best candidate in y of every row of x (out of its k nearest neighbours): scores and indexs"""
+    scores, indexs = knn(x, y, k, block)
+    if margin != 'cosine':
+        y_scores, _ = knn(y, x, k, block)
+        scores = margin_scores(scores, indexs, scores.mean(axis=1), y_scores.mean(axis=1), margin)
+    best = np.argmax(scores, axis=1)
+    rows = np.arange(len(x))
+    return scores[rows, best], indexs[rows, best]
+
+
+def read_lines(file):
+    if file is None:
+        return None
+    with open(file, 'rb') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def main(args):
+    o = options(args)
+    src = np.load(o.src, mmap_mode='r')
+    tgt = np.load(o.tgt, mmap_mode='r')
+    src_rows = unique_rows(o.src, src)
+    tgt_rows = unique_rows(o.tgt, tgt)
+    if src.shape[1] != tgt.shape[1]:
+        sys.stderr.write('error: -src and -tgt vectors have different sizes ({} and {})\n'.format(
+            src.shape[1], tgt.shape[1]))
+        sys.exit(1)
+    src_txt = read_lines(o.src_txt)
+    tgt_txt = read_lines(o.tgt_txt)
+    for txt, vecs, opt in [(src_txt, src, '-src_txt'), (tgt_txt, tgt, '-tgt_txt')]:
+        if txt is not None and len(txt) != len(vecs):
+            sys.stderr.write('error: {} has {} lines, vectors are {}\n'.format(opt, len(txt), len(vecs)))
+            sys.exit(1)
+    if len(src) == 0 or len(tgt) == 0:
+        sys.stderr.write('error: no vectors to mine\n')
+        sys.exit(1)
+
+    ini = time.time()
+    scores, indexs = mine(Rows(src, src_rows), Rows(tgt, tgt_rows), o.k, o.block, o.margin)
+    secs = time.time() - ini
+    ### unique sentences => lines
+    indexs = tgt_rows[indexs]
+
+    output = sys.stdout if o.output == '-' else open(o.output, 'wb')
+    npairs = 0
+    for u in np.argsort(-scores, kind='mergesort'):
+        if o.threshold is not None and scores[u] <= o.threshold:
+            break
+        s = src_rows[u]
+        line = ["{:.4f}".format(scores[u]), str(s+1), str(indexs[u]+1)]
+        if src_txt is not None:
+            line.append(src_txt[s])
+        if tgt_txt is not None:
+            line.append(tgt_txt[indexs[u]])
+        output.write("\t".join(line) + "\n")
+        npairs += 1
+    if output is not sys.stdout:
+        output.close()
+    sys.stderr.write('MINE src={} ({} unique) tgt={} ({} unique) pairs={} time(s)={:.2f} pairs/s={:.1f}\n'.format(
+        len(src), len(src_rows), len(tgt), len(tgt_rows), npairs, secs,
+        1.0 * len(src_rows) * len(tgt_rows) / max(secs, 1e-6)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
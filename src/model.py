@@ -6,71 +6,105 @@ import math
 import sys
 import os
 import time
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
 from random import randint
 from config import Config
-from dataset import minibatches
-from visualize import Visualize
-
-
-class Score():
-    def __init__(self):
-        self.TP = 0
-        self.TN = 0
-        self.FP = 0
-        self.FN = 0
-        self.A = 0.0
-        self.P = 0.0
-        self.R = 0.0
-        self.F = 0.0
-
-    def add(self, p, r):
-        ### prediction, reference
-        # when r < 0 => positive example, alignment exists (parallel sentence)
-        # when p > 0 => alignment exists in matrix (similarity is high)
-        if p*r <= 0:
-            if p >= 0:
-                # alignment predicted
-                self.TP += 1
-            else:
-                # alignment not predicted
-                self.TN += 1
-        else:
-            if p >= 0:
-                self.FP += 1
-            else:
-                self.FN += 1
-        # print("Pred:{} Ref:{}, TP:{} TN:{} FP:{} FN:{}".format(p, r, self.TP, self.TN, self.FP, self.FN))
-
-    def add_batch_tokens(self, p, r, l):
-        for s in range(len(l)):
-            ### sentence s of batch
-            for w in range(l[s]):
-                ### all words in sentence s (length is l[s])
-                self.add(p[s][w], r[s][w])
-
-    def add_batch(self, p, r):
-        for s in range(len(p)):
-            ### all sentences in batch
-            self.add(p[s], r[s])
-
-    def update(self):
-        self.A, self.P, self.R, self.F = 0.0, 0.0, 0.0, 0.0
-        if (self.TP + self.FP) > 0:
-            # true positives out of all that were predicted positive
-            self.P = 1. * self.TP / (self.TP + self.FP)
-        if (self.TP + self.FN) > 0:
-            # true positives out of all that were actually positive
-            self.R = 1. * self.TP / (self.TP + self.FN)
-        if (self.P + self.R) > 0.0:
-            self.F = 2. * self.P * self.R / (self.P + self.R)
-        if (self.TP + self.TN + self.FP + self.FN) > 0:
-            self.A = 1.0 * (self.TP + self.TN) / (self.TP + self.TN + self.FP + self.FN)
+from dataset import Padding
+from inference import batches, output_names, inference, encode, stage2_names, cascade_band, cascade
+from monitor import Monitor
+from score import Score, Scorer
+from profiler import Profiler
+from server import serve
+
+
+### value of masked cells (exp(.) is 0)
+MASKED = -1e30
+
+
+def masked(x, mask):
+    ### cells of x where mask is 0 are set to MASKED (selected rather than computed, which XLA fast math may reorder)
+    keep = tf.greater(mask + tf.zeros_like(x), 0.5)
+    return tf.where(keep, x, tf.fill(tf.shape(x), MASKED))
+
+
+def masked_reduce_logsumexp(x, mask, axis, name=None):
+    return tf.reduce_logsumexp(masked(x, mask), axis=axis, name=name)
+
+
+def masked_reduce_max(x, mask, axis, name=None):
+    return tf.reduce_max(masked(x, mask), axis=axis, name=name)
+
+
+def fused_bidirectional_rnn(size, inputs, sequence_length):
+    """same as bidirectional_dynamic_rnn over LSTMCell's (same variables) using fused LSTM kernels (the whole
+    sequence is run by a single op), time-major"""
+    inputs = tf.transpose(inputs, [1, 0, 2])
+    with tf.variable_scope("bidirectional_rnn"):
+        with tf.variable_scope("fw"):
+            cell_fw = tf.contrib.rnn.LSTMBlockFusedCell(size, name="lstm_cell")
+            output_fw, last_fw = cell_fw(inputs, sequence_length=sequence_length, dtype=tf.float32)
+        with tf.variable_scope("bw"):
+            ### backward direction runs over the reversed (real) words
+            cell_bw = tf.contrib.rnn.LSTMBlockFusedCell(size, name="lstm_cell")
+            inputs_rev = tf.reverse_sequence(inputs, sequence_length, seq_axis=0, batch_axis=1)
+            output_bw, last_bw = cell_bw(inputs_rev, sequence_length=sequence_length, dtype=tf.float32)
+            output_bw = tf.reverse_sequence(output_bw, sequence_length, seq_axis=0, batch_axis=1)
+    output_fw = tf.transpose(output_fw, [1, 0, 2])
+    output_bw = tf.transpose(output_bw, [1, 0, 2])
+    return (output_fw, output_bw), (last_fw, last_bw)
+
+
+@contextmanager
+def jit_scope(xla):
+    """ops created in this scope are compiled with XLA (if xla)"""
+    if not xla:
+        yield
+        return
+    from tensorflow.contrib.compiler import jit
+    with jit.experimental_jit_scope():
+        yield
+
+
+def cpu_share(nprocs, iproc):
+    """cpus used by process iproc out of nprocs co-located processes (disjoint shares when possible)"""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(multiprocessing.cpu_count()))
+    if nprocs >= len(cpus):
+        return [cpus[iproc % len(cpus)]]
+    size = len(cpus) // nprocs
+    return cpus[iproc*size:(iproc+1)*size]
+
+
+def pin_cpus(cpus):
+    ### threads created afterwards (session thread pools) inherit the affinity
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['taskset', '-a', '-p', '-c', ','.join(map(str, cpus)), str(os.getpid())],
+                                  stdout=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        sys.stderr.write('warning: cannot set cpu affinity (taskset not available)\n')
 
 
 class Model():
     def __init__(self, config):
         self.config = config
         self.sess = None
+        ### machine-readable stream of timings/throughput (json lines)
+        self.stats = None
+        if self.config.stats is not None:
+            self.stats = open(self.config.stats, 'a')
+        ### training steps run (over all epochs), some of them may be profiled
+        self.step = 0
+        self.profiler = None
+        if self.config.profile_steps is not None:
+            self.profiler = Profiler(self.config.profile_steps, self.config.mdir)
 
     def embedding_initialize(self, NS, ES, embeddings):
         if embeddings is not None:
@@ -123,11 +157,15 @@ class Model():
 
         with tf.variable_scope("lstm_src"):
             # print("SRC L1={}".format(L1))
-            cell_fw = tf.contrib.rnn.LSTMCell(L1, state_is_tuple=True)
-            cell_bw = tf.contrib.rnn.LSTMCell(L1, state_is_tuple=True)
-            (output_src_fw, output_src_bw), (last_src_fw, last_src_bw) = \
-                tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, self.embed_src,
-                                                sequence_length=self.len_src, dtype=tf.float32)
+            if self.config.lstm_impl == "fused":
+                (output_src_fw, output_src_bw), (last_src_fw, last_src_bw) = \
+                    fused_bidirectional_rnn(L1, self.embed_src, self.len_src)
+            else:
+                cell_fw = tf.contrib.rnn.LSTMCell(L1, state_is_tuple=True)
+                cell_bw = tf.contrib.rnn.LSTMCell(L1, state_is_tuple=True)
+                (output_src_fw, output_src_bw), (last_src_fw, last_src_bw) = \
+                    tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, self.embed_src,
+                                                    sequence_length=self.len_src, dtype=tf.float32)
 
         ### divergence
         self.last_src = tf.concat([last_src_fw[1], last_src_bw[1]], axis=1)
@@ -157,11 +195,15 @@ class Model():
 
         with tf.variable_scope("lstm_tgt"):
             # print("TGT L1={}".format(L1))
-            cell_fw = tf.contrib.rnn.LSTMCell(L1, state_is_tuple=True)
-            cell_bw = tf.contrib.rnn.LSTMCell(L1, state_is_tuple=True)
-            (output_tgt_fw, output_tgt_bw), (last_tgt_fw, last_tgt_bw) = \
-                tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, self.embed_tgt,
-                                                sequence_length=self.len_tgt, dtype=tf.float32)
+            if self.config.lstm_impl == "fused":
+                (output_tgt_fw, output_tgt_bw), (last_tgt_fw, last_tgt_bw) = \
+                    fused_bidirectional_rnn(L1, self.embed_tgt, self.len_tgt)
+            else:
+                cell_fw = tf.contrib.rnn.LSTMCell(L1, state_is_tuple=True)
+                cell_bw = tf.contrib.rnn.LSTMCell(L1, state_is_tuple=True)
+                (output_tgt_fw, output_tgt_bw), (last_tgt_fw, last_tgt_bw) = \
+                    tf.nn.bidirectional_dynamic_rnn(cell_fw, cell_bw, self.embed_tgt,
+                                                    sequence_length=self.len_tgt, dtype=tf.float32)
 
         ### divergence
         self.last_tgt = tf.concat([last_tgt_fw[1], last_tgt_bw[1]], axis=1)
@@ -203,36 +245,34 @@ class Model():
         if self.config.mode == "alignment":
             R = self.config.r
 #            print("R={}".format(R))
-            with tf.name_scope("align"):
-                self.align = tf.map_fn(lambda (x, y): tf.matmul(x, tf.transpose(y)),
-                                       (self.out_src, self.out_tgt), dtype=tf.float32, name="align")
-            with tf.name_scope("aggregation"):
-                if self.config.aggr == "lse":
-                    self.aggregation_src = tf.divide(tf.log(tf.map_fn(lambda (x, l): tf.reduce_sum(x[:l, :], 0),
-                                                     (tf.exp(tf.transpose(self.align, [0, 2, 1]) * R), self.len_tgt),
-                                                     dtype=tf.float32)), R, name="aggregation_src")
-                    self.aggregation_tgt = tf.divide(tf.log(tf.map_fn(lambda (x, l): tf.reduce_sum(x[:l, :], 0),
-                                                            (tf.exp(self.align * R), self.len_src), dtype=tf.float32)),
-                                                     R, name="aggregation_tgt")
-                elif self.config.aggr == "sum":
-                    self.aggregation_src = tf.map_fn(lambda (x, l): tf.reduce_sum(x[:l, :], 0),
-                                                     (tf.transpose(self.align, [0, 2, 1]), self.len_tgt),
-                                                     dtype=tf.float32, name="aggregation_src")
-                    self.aggregation_tgt = tf.map_fn(lambda (x, l): tf.reduce_sum(x[:l, :], 0),
-                                                     (self.align, self.len_src),
-                                                     dtype=tf.float32, name="aggregation_tgt")
-                elif self.config.aggr == "max":
-                    self.aggregation_src = tf.map_fn(lambda (x, l): tf.reduce_max(x[:l, :], axis=0),
-                                                     (tf.transpose(self.align, [0, 2, 1]), self.len_tgt),
-                                                     dtype=tf.float32, name="aggregation_src")
-                    self.aggregation_tgt = tf.map_fn(lambda (x, l): tf.reduce_max(x[:l, :], axis=0),
-                                                     (self.align, self.len_src),
-                                                     dtype=tf.float32, name="aggregation_tgt")
-                else:
-                    sys.stderr.write("error: bad aggregation option '{}'\n".format(self.config.aggr))
-                    sys.exit(1)
-                self.output_src = tf.log(1 + tf.exp(self.aggregation_src * self.sign_src))
-                self.output_tgt = tf.log(1 + tf.exp(self.aggregation_tgt * self.sign_tgt))
+            ### with -xla, alignment and aggregation ops are compiled (fused) by XLA
+            with jit_scope(self.config.xla):
+                with tf.name_scope("align"):
+                    ### Shape: batch_size x |Fj| x |Ei|
+                    self.align = tf.matmul(self.out_src, self.out_tgt, transpose_b=True, name="align")
+                with tf.name_scope("aggregation"):
+                    ### masks of real (not padded) words. Shape: batch_size x |Fj| and batch_size x |Ei|
+                    self.mask_src = tf.sequence_mask(self.len_src, tf.shape(self.align)[1], dtype=tf.float32)
+                    self.mask_tgt = tf.sequence_mask(self.len_tgt, tf.shape(self.align)[2], dtype=tf.float32)
+                    ### src words aggregate over real tgt words, tgt words over real src words
+                    mask_src = tf.expand_dims(self.mask_src, 2)
+                    mask_tgt = tf.expand_dims(self.mask_tgt, 1)
+                    if self.config.aggr == "lse":
+                        self.aggregation_src = tf.divide(masked_reduce_logsumexp(self.align * R, mask_tgt, axis=2), R,
+                                                         name="aggregation_src")
+                        self.aggregation_tgt = tf.divide(masked_reduce_logsumexp(self.align * R, mask_src, axis=1), R,
+                                                         name="aggregation_tgt")
+                    elif self.config.aggr == "sum":
+                        self.aggregation_src = tf.reduce_sum(self.align * mask_tgt, axis=2, name="aggregation_src")
+                        self.aggregation_tgt = tf.reduce_sum(self.align * mask_src, axis=1, name="aggregation_tgt")
+                    elif self.config.aggr == "max":
+                        self.aggregation_src = masked_reduce_max(self.align, mask_tgt, axis=2, name="aggregation_src")
+                        self.aggregation_tgt = masked_reduce_max(self.align, mask_src, axis=1, name="aggregation_tgt")
+                    else:
+                        sys.stderr.write("error: bad aggregation option '{}'\n".format(self.config.aggr))
+                        sys.exit(1)
+                    self.output_src = tf.log(1 + tf.exp(self.aggregation_src * self.sign_src))
+                    self.output_tgt = tf.log(1 + tf.exp(self.aggregation_tgt * self.sign_tgt))
 
     def add_loss(self):
         with tf.name_scope("loss"):
@@ -242,10 +282,8 @@ class Model():
                 self.loss = tf.reduce_sum(tf.log(1 + tf.exp(self.output * self.sign)))
                 # self.loss=tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(labels=self.sign,logits=self.output))
             else:
-                self.loss_src = tf.reduce_mean(tf.map_fn(lambda (x, l): tf.reduce_sum(x[:l]),
-                                                         (self.output_src, self.len_src), dtype=tf.float32))
-                self.loss_tgt = tf.reduce_mean(tf.map_fn(lambda (x, l): tf.reduce_sum(x[:l]),
-                                                         (self.output_tgt, self.len_tgt), dtype=tf.float32))
+                self.loss_src = tf.reduce_mean(tf.reduce_sum(self.output_src * self.mask_src, axis=1))
+                self.loss_tgt = tf.reduce_mean(tf.reduce_sum(self.output_tgt * self.mask_tgt, axis=1))
                 self.loss = self.loss_tgt + self.loss_src
 
     def add_train(self):
@@ -269,9 +307,10 @@ class Model():
         # self.train_op = optimizer.apply_gradients(zip(grads, tvars))
 
     def build_graph(self):
+        tf.set_random_seed(self.config.seed)
         self.add_placeholders()
         self.add_model()
-        if self.config.tst is None:
+        if self.config.tst is None and self.config.encode is None and self.config.serve is None:
             self.add_loss()
             self.add_train()
 
@@ -292,6 +331,15 @@ class Model():
         }
         return feed
 
+    def minibatches(self, data, bucket=0, padding=None):
+        return batches(self.config, data, bucket, padding)
+
+    def nbatches(self, data):
+        if self.config.batch_tokens > 0:
+            ### unknown before batches are built
+            return '?'
+        return (len(data) + self.config.batch_size - 1) // self.config.batch_size
+
 ###################
 ### learning ######
 ###################
@@ -301,7 +349,7 @@ class Model():
         #######################
         # learn on trainset ###
         #######################
-        nbatches = (len(train) + self.config.batch_size - 1) // self.config.batch_size
+        nbatches = self.nbatches(train)
         curr_epoch = self.config.last_epoch + 1
         # training loss
         TLOSS = 0.0
@@ -309,20 +357,34 @@ class Model():
         ILOSS = 0.0
         tscore = Score()
         iscore = Score()
+        scorer = Scorer(self.config.async_score)
+        padding = Padding()
+        batches = self.minibatches(train, self.config.bucket, padding)
         ini_time = time.time()
+        monitor = Monitor('train', self.stats)
         for iter, (src_batch, tgt_batch, raw_src_batch, raw_tgt_batch, sign_src_batch,
-                   sign_tgt_batch, sign_batch, len_src_batch, len_tgt_batch) in \
-                enumerate(minibatches(train, self.config.batch_size)):
+                   sign_tgt_batch, sign_batch, len_src_batch, len_tgt_batch) in enumerate(batches):
+            monitor.lap('batch')
+            monitor.add_batch(len_src_batch, len_tgt_batch, src_batch.shape[1], tgt_batch.shape[1])
             fd = self.get_feed_dict(src_batch, tgt_batch, sign_src_batch, sign_tgt_batch, sign_batch,
                                     len_src_batch, len_tgt_batch, lr)
+            monitor.lap('feed')
+            self.step += 1
+            run_args = self.profiler.run_args(self.step) if self.profiler is not None else {}
             if self.config.mode == "sentence":
-                _, loss, out = self.sess.run([self.train_op, self.loss, self.output], feed_dict=fd)
-                tscore.add_batch(out, sign_batch)
-                iscore.add_batch(out, sign_batch)
+                _, loss, out = self.sess.run([self.train_op, self.loss, self.output], feed_dict=fd, **run_args)
             else:
                 _, loss, aggr_src, aggr_tgt, last_src, last_tgt = self.sess.run([
                     self.train_op, self.loss, self.aggregation_src, self.aggregation_tgt, self.last_src,
-                    self.last_tgt], feed_dict=fd)
+                    self.last_tgt], feed_dict=fd, **run_args)
+            monitor.lap('run')
+            if run_args:
+                ### traces are written out of the timed stages
+                self.profiler.collect(self.step, run_args['run_metadata'])
+                monitor.skip()
+            if self.config.mode == "sentence":
+                scorer.add([tscore, iscore], out, sign_batch)
+            else:
                 # print("src_batch is {}".format(src_batch[0]))
                 # print("tgt_batch is {}".format(tgt_batch[0]))
                 # print("loss is {}".format(loss))
@@ -331,23 +393,29 @@ class Model():
                 # print("last_src is {}".format(last_src[0]))
                 # print("last_tgt is {}".format(last_tgt[0]))
                 # if iter==2: sys.exit()
-                tscore.add_batch_tokens(aggr_src, sign_src_batch, len_src_batch)
-                tscore.add_batch_tokens(aggr_tgt, sign_tgt_batch, len_tgt_batch)
-                iscore.add_batch_tokens(aggr_src, sign_src_batch, len_src_batch)
-                iscore.add_batch_tokens(aggr_tgt, sign_tgt_batch, len_tgt_batch)
+                scorer.add([tscore, iscore], aggr_src, sign_src_batch, len_src_batch)
+                scorer.add([tscore, iscore], aggr_tgt, sign_tgt_batch, len_tgt_batch)
             TLOSS += loss
             ILOSS += loss
 
             if (iter+1) % self.config.report_every == 0:
                 curr_time = time.strftime("[%Y-%m-%d_%X]", time.localtime())
+                scorer.wait()
+                monitor.lap('score')
                 iscore.update()
                 ILOSS = ILOSS/self.config.report_every
-                sys.stdout.write('{} Epoch {} Iteration {}/{} loss:{:.4f} (A{:.4f},P{:.4f},R{:.4f},F{:.4f})\n'.format(
-                    curr_time, curr_epoch, iter+1, nbatches, ILOSS, iscore.A, iscore.P, iscore.R, iscore.F))
+                sys.stdout.write('{} Epoch {} Iteration {}/{} loss:{:.4f} (A{:.4f},P{:.4f},R{:.4f},F{:.4f}) {}'
+                                 '\n'.format(curr_time, curr_epoch, iter+1, nbatches, ILOSS, iscore.A, iscore.P,
+                                             iscore.R, iscore.F, monitor.line()))
+                monitor.record(kind='report', epoch=curr_epoch, iter=iter+1, loss=ILOSS, A=iscore.A, P=iscore.P,
+                               R=iscore.R, F=iscore.F, lr=lr)
                 ILOSS = 0.0
                 iscore = Score()
+            monitor.lap('score')
 
-        TLOSS = TLOSS/nbatches
+        TLOSS = TLOSS/(iter+1)
+        scorer.wait()
+        monitor.lap('score')
         tscore.update()
         curr_time = time.strftime("[%Y-%m-%d_%X]", time.localtime())
         sys.stdout.write('{} Epoch {} TRAIN loss={:.4f} (A{:.4f},P{:.4f},R{:.4f},F{:.4f}) lr={:.4f}'.format(
@@ -356,34 +424,50 @@ class Model():
         unk_tgt = float(100) * train.nunk_tgt / train.ntgt
         div_src = float(100) * train.ndiv_src / train.nsrc
         div_tgt = float(100) * train.ndiv_tgt / train.ntgt
-        sys.stdout.write(' Train set: words={}/{} %div={:.2f}/{:.2f} %unk={:.2f}/{:.2f}\n'.format(
-            train.nsrc, train.ntgt, div_src, div_tgt, unk_src, unk_tgt))
+        eff_src, eff_tgt, eff_align = padding.efficiency()
+        sys.stdout.write(' Train set: words={}/{} %div={:.2f}/{:.2f} %unk={:.2f}/{:.2f}'
+                         ' %pad_eff={:.2f}/{:.2f}/{:.2f}\n'.format(
+                             train.nsrc, train.ntgt, div_src, div_tgt, unk_src, unk_tgt, eff_src, eff_tgt, eff_align))
+        sys.stdout.write('{} Epoch {} TRAIN {}\n'.format(curr_time, curr_epoch, monitor.line(window=False)))
+        if self.config.prefetch > 0:
+            sys.stdout.write('{} Epoch {} TRAIN {}\n'.format(curr_time, curr_epoch, batches.stats()))
+        ### recorded before validation: train time and throughput do not include the dev loop
+        monitor.record(kind='epoch', epoch=curr_epoch, loss=TLOSS, A=tscore.A, P=tscore.P, R=tscore.R, F=tscore.F,
+                       lr=lr)
 
         ##########################
         # evaluate over devset ###
         ##########################
         VLOSS = 0.0
         if dev is not None:
-            nbatches = (len(dev) + self.config.batch_size - 1) // self.config.batch_size
             # iterate over dataset
             VLOSS = 0
             vscore = Score()
+            vmonitor = Monitor('valid', self.stats)
             for iter, (src_batch, tgt_batch, raw_src_batch, raw_tgt_batch, sign_src_batch, sign_tgt_batch, sign_batch,
-                       len_src_batch, len_tgt_batch) in enumerate(minibatches(dev, self.config.batch_size)):
+                       len_src_batch, len_tgt_batch) in enumerate(self.minibatches(dev, self.config.bucket)):
+                vmonitor.lap('batch')
+                vmonitor.add_batch(len_src_batch, len_tgt_batch, src_batch.shape[1], tgt_batch.shape[1])
                 fd = self.get_feed_dict(src_batch, tgt_batch, sign_src_batch, sign_tgt_batch, sign_batch, len_src_batch,
                                         len_tgt_batch, 0.0)
+                vmonitor.lap('feed')
                 if self.config.mode == "sentence":
                     loss, out = self.sess.run([self.loss, self.output], feed_dict=fd)
-                    vscore.add_batch(out, sign_batch)
+                    vmonitor.lap('run')
+                    scorer.add([vscore], out, sign_batch)
                 else:
                     loss, aggr_src, aggr_tgt = self.sess.run([self.loss, self.aggregation_src, self.aggregation_tgt],
                                                              feed_dict=fd)
-                    vscore.add_batch_tokens(aggr_src, sign_src_batch, len_src_batch)
-                    vscore.add_batch_tokens(aggr_tgt, sign_tgt_batch, len_tgt_batch)
+                    vmonitor.lap('run')
+                    scorer.add([vscore], aggr_src, sign_src_batch, len_src_batch)
+                    scorer.add([vscore], aggr_tgt, sign_tgt_batch, len_tgt_batch)
                 # append single value which is a mean of losses of the n examples in the batch
                 VLOSS += loss
+                vmonitor.lap('score')
+            scorer.wait()
+            vmonitor.lap('score')
             vscore.update()
-            VLOSS = VLOSS / nbatches
+            VLOSS = VLOSS / (iter+1)
             sys.stdout.write('{} Epoch {} VALID loss={:.4f} (A{:.4f},P{:.4f},R{:.4f},F{:.4f})'.format(
                 curr_time, curr_epoch, VLOSS, vscore.A, vscore.P, vscore.R, vscore.F))
             unk_src = float(100) * dev.nunk_src / dev.nsrc
@@ -392,6 +476,10 @@ class Model():
             div_tgt = float(100) * dev.ndiv_tgt / dev.ntgt
             sys.stdout.write(' Valid set words={}/{} %div={:.2f}/{:.2f} %unk={:.2f}/{:.2f}\n'.format(
                 dev.nsrc, dev.ntgt, div_src, div_tgt, unk_src, unk_tgt, VLOSS, vscore.A, vscore.P, vscore.R, vscore.F))
+            sys.stdout.write('{} Epoch {} VALID {}\n'.format(curr_time, curr_epoch, vmonitor.line(window=False)))
+            vmonitor.record(kind='epoch', epoch=curr_epoch, loss=VLOSS, A=vscore.A, P=vscore.P, R=vscore.R, F=vscore.F)
+
+        scorer.close()
 
         ##################################
         # keep record of current epoch ###
@@ -404,7 +492,14 @@ class Model():
         self.config.time = time.strftime("[%Y-%m-%d_%X]", time.localtime())
         self.config.seconds = "{:.2f}".format(time.time() - ini_time)
         self.config.last_epoch += 1
+        ### the checkpoint is saved after the train epoch record: its time is written in a save record
+        ini_save = time.time()
+        monitor.skip()
         self.save_session(self.config.last_epoch)
+        monitor.lap('save')
+        save_secs = time.time() - ini_save
+        sys.stdout.write('{} Epoch {} TRAIN time(s): save={:.2f}\n'.format(curr_time, curr_epoch, save_secs))
+        monitor.record(kind='save', epoch=curr_epoch, seconds=round(save_secs, 3))
         if dev is not None:
             self.config.vloss = VLOSS
             self.config.vA = vscore.A
@@ -417,9 +512,12 @@ class Model():
     def learn(self, train, dev, n_epochs):
         lr = self.config.lr
         curr_time = time.strftime("[%Y-%m-%d_%X]", time.localtime())
-        sys.stdout.write("{} Training with {} sentence pairs: {} batches with up to {} examples each.\n".format(
-            curr_time, len(train), (len(train)+self.config.batch_size-1)//self.config.batch_size,
-            self.config.batch_size))
+        if self.config.batch_tokens > 0:
+            sys.stdout.write("{} Training with {} sentence pairs: batches with up to {} tokens each.\n".format(
+                curr_time, len(train), self.config.batch_tokens))
+        else:
+            sys.stdout.write("{} Training with {} sentence pairs: {} batches with up to {} examples each.\n".format(
+                curr_time, len(train), self.nbatches(train), self.config.batch_size))
         best_score = 0
         best_epoch = 0
         for iter in range(n_epochs):
@@ -437,85 +535,91 @@ class Model():
 ### inference #####
 ###################
 
-    def inference(self, tst, output, quiet=False):
+    def inference_fetches(self, annotated, quiet):
+        """only tensors needed by the output flags are fetched (the align subgraph is not run when only the
+        similarity score is needed)"""
+        tensors = {'align': 'align', 'aggr_src': 'aggregation_src', 'aggr_tgt': 'aggregation_tgt',
+                   'last_src': 'last_src', 'last_tgt': 'last_tgt'}
+        tensors['sim'] = 'output' if self.config.mode == "sentence" else 'cos_similarity'
+        return dict((name, getattr(self, tensors[name])) for name in output_names(self.config, annotated, quiet))
 
-        if self.config.show_svg:
-            output.write("<html>\n<body>\n")
-        nbatches = (len(tst) + self.config.batch_size - 1) // self.config.batch_size
-        score = Score()
-        n_sents = 0
-        for iter, (src_batch, tgt_batch, raw_src_batch, raw_tgt_batch, sign_src_batch, sign_tgt_batch, sign_batch,
-                   len_src_batch, len_tgt_batch) in enumerate(minibatches(tst, self.config.batch_size)):
+    def inference(self, tst, output, quiet=False):
+        fetches = self.inference_fetches(tst.annotated, quiet)
+        ### with -cascade, the align subgraph is run in a second step over the encoder outputs of some pairs
+        stage2 = {}
+        if self.config.cascade is not None:
+            low, high = cascade_band(self.config)
+            stage2 = dict((name, fetches.pop(name)) for name in stage2_names if name in fetches)
+            if stage2:
+                fetches['out_src'] = self.out_src
+                fetches['out_tgt'] = self.out_tgt
+
+        def run(batch, monitor):
+            (src_batch, tgt_batch, raw_src_batch, raw_tgt_batch, sign_src_batch, sign_tgt_batch, sign_batch,
+             len_src_batch, len_tgt_batch) = batch
             fd = self.get_feed_dict(src_batch, tgt_batch, sign_src_batch, sign_tgt_batch, sign_batch, len_src_batch,
                                     len_tgt_batch, 0.0)
+            monitor.lap('feed')
+            out = self.sess.run(fetches, feed_dict=fd)
+            if not stage2:
+                return out
 
-            if self.config.mode == "sentence":
-                out_batch, last_src_batch, last_tgt_batch = self.sess.run([self.output, self.last_src, self.last_tgt],
-                                                                          feed_dict=fd)
-                if tst.annotated:
-                    score.add_batch(out_batch, sign_batch)
-                for i_sent in range(len(out_batch)):
-                    n_sents += 1
-                    v = Visualize(output, n_sents, raw_src_batch[i_sent], raw_tgt_batch[i_sent], out_batch[i_sent])
-                    last_src = []
-                    last_tgt = []
-                    if self.config.show_last:
-                        last_src = last_src_batch[i_sent]
-                        last_tgt = last_tgt_batch[i_sent]
-                    v.print_vectors(last_src, last_tgt, aggr_src=[], aggr_tgt=[], align=[], quiet=quiet)
-            else:
-                align_batch, aggr_src_batch, aggr_tgt_batch, out_src_batch, out_tgt_batch, last_src_batch, \
-                    last_tgt_batch, sim_batch = self.sess.run([self.align, self.aggregation_src,
-                                                               self.aggregation_tgt, self.out_src, self.out_tgt,
-                                                               self.last_src, self.last_tgt, self.cos_similarity],
-                                                              feed_dict=fd)
-                if tst.annotated:
-                    score.add_batch_tokens(aggr_src_batch, sign_src_batch, len_src_batch)
-                    score.add_batch_tokens(aggr_tgt_batch, sign_tgt_batch, len_tgt_batch)
-                for i_sent in range(len(align_batch)):
-                    n_sents += 1
-                    v = Visualize(output, n_sents, raw_src_batch[i_sent], raw_tgt_batch[i_sent], sim_batch[i_sent])
-                    if self.config.show_svg:
-                        v.print_svg(aggr_src_batch[i_sent], aggr_tgt_batch[i_sent], align_batch[i_sent])
-                    elif self.config.show_matrix:
-                        v.print_matrix(aggr_src_batch[i_sent], aggr_tgt_batch[i_sent], align_batch[i_sent])
-                    else:
-                        last_src = []
-                        last_tgt = []
-                        aggr_src = []
-                        aggr_tgt = []
-                        align = []
-                        if self.config.show_last:
-                            last_src = last_src_batch[i_sent]
-                            last_tgt = last_tgt_batch[i_sent]
-                        if self.config.show_aggr:
-                            aggr_src = aggr_src_batch[i_sent]
-                            aggr_tgt = aggr_tgt_batch[i_sent]
-                        if self.config.show_align:
-                            align = align_batch[i_sent]
-                        v.print_vectors(last_src, last_tgt, aggr_src, aggr_tgt, align, quiet=quiet)
-
-        if tst.annotated:
-            score.update()
-            unk_s = float(100) * tst.nunk_src / tst.nsrc
-            unk_t = float(100) * tst.nunk_tgt / tst.ntgt
-            div_s = float(100) * tst.ndiv_src / tst.nsrc
-            div_t = float(100) * tst.ndiv_tgt / tst.ntgt
-            sys.stderr.write('TEST words={}/{} %div={:.2f}/{:.2f} %unk={:.2f}/{:.2f} (A{:.4f},P{:.4f},R{:.4f},F{:.4f})'
-                             ' (TP:{},TN:{},FP:{},FN:{})\n'.format(
-                                    tst.nsrc, tst.ntgt, div_s, div_t, unk_s, unk_t, score.A, score.P, score.R, score.F,
-                                    score.TP, score.TN, score.FP, score.FN))
-
-        if self.config.show_svg:
-            output.write("</body>\n</html>\n")
+            def run_stage2(rows):
+                return self.sess.run(stage2, feed_dict={self.out_src: out['out_src'][rows],
+                                                        self.out_tgt: out['out_tgt'][rows],
+                                                        self.len_src: len_src_batch[rows],
+                                                        self.len_tgt: len_tgt_batch[rows]})
+
+            return cascade(out, stage2, len_src_batch, len_tgt_batch, low, high, run_stage2)
+
+        inference(self.config, tst, output, run, self.stats, quiet)
+
+    def encode(self, sents, output):
+        """last vectors of sents (only the encoder of -side is run)"""
+        if self.config.side == "src":
+            input, length, last = self.input_src, self.len_src, self.last_src
+        else:
+            input, length, last = self.input_tgt, self.len_tgt, self.last_tgt
+
+        def run(input_batch, len_batch):
+            return self.sess.run(last, feed_dict={input: input_batch, length: len_batch})
+
+        encode(self.config, sents, output, run, self.stats)
+
+    def serve(self):
+        """similarity scores of pairs sent to -serve (the session is kept until the server is interrupted)"""
+        sim = self.output if self.config.mode == "sentence" else self.cos_similarity
+
+        def run(input_src, input_tgt, len_src, len_tgt):
+            return self.sess.run(sim, feed_dict={self.input_src: input_src, self.input_tgt: input_tgt,
+                                                 self.len_src: len_src, self.len_tgt: len_tgt})
+
+        serve(self.config, run, self.stats)
 
 
 ###################
 ### session #######
 ###################
 
+    def session_config(self):
+        intra = self.config.intra_threads
+        inter = self.config.inter_threads
+        if self.config.procs is not None:
+            ### process I out of N running on the same host: pinned to its share of cpus, one thread per cpu
+            nprocs, iproc = map(int, self.config.procs.split(':'))
+            cpus = cpu_share(nprocs, iproc)
+            pin_cpus(cpus)
+            if intra == 0:
+                intra = len(cpus)
+            if inter == 0:
+                inter = 1
+            sys.stderr.write('Process {} of {} uses cpus {} (intra_threads={} inter_threads={})\n'.format(
+                iproc, nprocs, ','.join(map(str, cpus)), intra, inter))
+        ### 0 lets tensorflow decide (one thread per core)
+        return tf.ConfigProto(intra_op_parallelism_threads=intra, inter_op_parallelism_threads=inter)
+
     def initialize_session(self):
-        self.sess = tf.Session()
+        self.sess = tf.Session(config=self.session_config())
         self.saver = tf.train.Saver(max_to_keep=20)
 
         if self.config.epoch is not None:
@@ -543,3 +647,5 @@ class Model():
 
     def close_session(self):
         self.sess.close()
+        if self.stats is not None:
+            self.stats.close()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import time
+import json
+import resource
+
+### stages of the training/inference loops
+stages = ['batch', 'feed', 'run', 'score', 'output', 'save']
+
+
+def peak_rss():
+    """peak resident memory of the process in MB (ru_maxrss is given in KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def parse_steps(steps):
+    """'a:b' => (a, b)"""
+    try:
+        first, last = map(int, steps.split(':'))
+    except ValueError:
+        return None
+    if first < 1 or last < first:
+        return None
+    return first, last
+
+
+class Counts():
+    """seconds spent in each stage and data processed since ini"""
+
+    def __init__(self):
+        self.ini = time.time()
+        self.seconds = dict((stage, 0.0) for stage in stages)
+        self.batches = 0
+        self.pairs = 0
+        self.src = 0
+        self.tgt = 0
+        self.src_cells = 0
+        self.tgt_cells = 0
+
+    def stats(self):
+        elapsed = max(time.time() - self.ini, 1e-6)
+        stats = {
+            'elapsed': round(elapsed, 3),
+            'seconds': dict((stage, round(self.seconds[stage], 3)) for stage in stages),
+            'batches': self.batches,
+            'step_time': round(elapsed / max(self.batches, 1), 4),
+            'pairs': self.pairs,
+            'pairs_per_sec': round(self.pairs / elapsed, 2),
+            'src_tokens_per_sec': round(self.src / elapsed, 2),
+            'tgt_tokens_per_sec': round(self.tgt / elapsed, 2),
+            'src_padding': 0.0,
+            'tgt_padding': 0.0}
+        ### percentage of padded cells
+        if self.src_cells > 0:
+            stats['src_padding'] = round(100.0 * (self.src_cells - self.src) / self.src_cells, 2)
+        if self.tgt_cells > 0:
+            stats['tgt_padding'] = round(100.0 * (self.tgt_cells - self.tgt) / self.tgt_cells, 2)
+        return stats
+
+
+class Monitor():
+    """per-stage timers of a loop over batches, cumulative (total) and since the last report (window), written
+    in progress lines and as json lines in stats file (if any) together with the metrics of the loop"""
+
+    def __init__(self, phase, stats=None):
+        self.phase = phase
+        self.stats = stats
+        self.total = Counts()
+        self.window = Counts()
+        self.last = time.time()
+
+    def lap(self, stage):
+        ### time since the previous lap is spent in stage
+        now = time.time()
+        self.total.seconds[stage] += now - self.last
+        self.window.seconds[stage] += now - self.last
+        self.last = now
+
+    def skip(self):
+        ### time since the previous lap is not accounted
+        self.last = time.time()
+
+    def add_batch(self, len_src, len_tgt, max_src, max_tgt):
+        for counts in [self.total, self.window]:
+            counts.batches += 1
+            counts.pairs += len(len_src)
+            counts.src += int(len_src.sum())
+            counts.tgt += int(len_tgt.sum())
+            counts.src_cells += len(len_src) * max_src
+            counts.tgt_cells += len(len_tgt) * max_tgt
+
+    def line(self, window=True):
+        stats = (self.window if window else self.total).stats()
+        seconds = ' '.join('{}={:.2f}'.format(stage, stats['seconds'][stage]) for stage in stages
+                           if stage in ['batch', 'feed', 'run', 'score'] or stats['seconds'][stage] > 0)
+        return 'time(s): {} pairs/s={:.1f} tok/s={:.1f}/{:.1f} %pad={:.2f}/{:.2f} rss={:.0f}MB'.format(
+            seconds, stats['pairs_per_sec'], stats['src_tokens_per_sec'], stats['tgt_tokens_per_sec'],
+            stats['src_padding'], stats['tgt_padding'], peak_rss())
+
+    def record(self, **fields):
+        """writes a json line with both windowed and cumulative stats, then starts a new window"""
+        if self.stats is not None:
+            rec = {'time': round(time.time(), 3), 'phase': self.phase}
+            rec.update(fields)
+            rec['window'] = self.window.stats()
+            rec['total'] = self.total.stats()
+            rec['peak_rss_mb'] = round(peak_rss(), 1)
+            self.stats.write(json.dumps(rec, sort_keys=True) + '\n')
+            self.stats.flush()
+        self.window = Counts()
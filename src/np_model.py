@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from checkpoint import Checkpoint
+from inference import output_names, inference, encode, stage2_names, cascade_band, cascade
+from server import serve
+
+### value of masked cells (exp(.) is 0), as in model.py
+MASKED = -1e30
+### LSTMCell default
+FORGET_BIAS = 1.0
+
+
+def sigmoid(x):
+    ### does not overflow for large negative x
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def reverse_sequence(x, lengths):
+    """reverses the first lengths[b] steps of each sequence x[b] (padded steps stay in place)"""
+    steps = np.arange(x.shape[1])
+    idx = np.where(steps < lengths[:, None], lengths[:, None] - 1 - steps, steps)
+    return x[np.arange(x.shape[0])[:, None], idx]
+
+
+def lstm(x, lengths, kernel, bias):
+    """dynamic_rnn over LSTMCell (gates i, j, f, o): outputs (zeros past lengths) and last h, input projections of
+    all steps are computed at once, then a matrix product per step"""
+    B, T, D = x.shape
+    H = bias.shape[0] // 4
+    xw = np.dot(x.reshape(B*T, D), kernel[:D]).reshape(B, T, 4*H) + bias
+    wh = kernel[D:]
+    h = np.zeros((B, H), dtype=np.float32)
+    c = np.zeros((B, H), dtype=np.float32)
+    out = np.zeros((B, T, H), dtype=np.float32)
+    for t in range(T):
+        gates = xw[:, t] + np.dot(h, wh)
+        i, j, f, o = np.split(gates, 4, axis=1)
+        c_t = sigmoid(f + FORGET_BIAS) * c + sigmoid(i) * np.tanh(j)
+        h_t = sigmoid(o) * np.tanh(c_t)
+        ### states are kept past the end of each sequence
+        live = (t < lengths)[:, None]
+        c = np.where(live, c_t, c)
+        h = np.where(live, h_t, h)
+        out[:, t] = np.where(live, h_t, 0.0)
+    return out, h
+
+
+def l2_normalize(x):
+    return x / np.sqrt(np.maximum(np.sum(x * x, axis=1, keepdims=True), 1e-12))
+
+
+def masked_logsumexp(x, mask, axis):
+    x = np.where(mask > 0.5, x, MASKED)
+    m = np.max(x, axis=axis, keepdims=True)
+    return np.squeeze(m, axis=axis) + np.log(np.sum(np.exp(x - m), axis=axis))
+
+
+def masked_max(x, mask, axis):
+    return np.max(np.where(mask > 0.5, x, MASKED), axis=axis)
+
+
+class NumpyModel():
+    """forward pass of a model (inference) with numpy only: variables are read from mdir/epochN (no tensorflow
+    needed), outputs are those of the tensorflow graph (model.py) up to float rounding"""
+
+    def __init__(self, config):
+        self.config = config
+        self.cascade = None
+        if self.config.cascade is not None:
+            self.cascade = cascade_band(self.config)
+        self.stats = None
+        if self.config.stats is not None:
+            self.stats = open(self.config.stats, 'a')
+        fmodel = '{}/epoch{}'.format(self.config.mdir, self.config.epoch)
+        sys.stderr.write("Restoring model: {}\n".format(fmodel))
+        ckpt = Checkpoint(fmodel)
+        self.LT_src = ckpt.tensor('embedding_src/embeddings_src')
+        self.LT_tgt = ckpt.tensor('embedding_tgt/embeddings_tgt')
+        self.lstm_src = {}
+        self.lstm_tgt = {}
+        for side, cells in [('src', self.lstm_src), ('tgt', self.lstm_tgt)]:
+            for dir in ['fw', 'bw']:
+                scope = 'lstm_{}/bidirectional_rnn/{}/lstm_cell/'.format(side, dir)
+                cells[dir] = (ckpt.tensor(scope + 'kernel'), ckpt.tensor(scope + 'bias'))
+        if self.config.mode == "sentence":
+            ### tf.layers.dense variables
+            self.dense = [(ckpt.tensor(scope + '/kernel'), ckpt.tensor(scope + '/bias'))
+                          for scope in ['dense', 'dense_1']]
+        elif self.config.aggr not in ["lse", "sum", "max"]:
+            sys.stderr.write("error: bad aggregation option '{}'\n".format(self.config.aggr))
+            sys.exit(1)
+
+    def bilstm(self, LT, cells, input, lengths):
+        """bi-lstm over the embeddings of input: outputs (B x S x 2H) and last vectors (B x 2H)"""
+        embed = LT[input]
+        out_fw, last_fw = lstm(embed, lengths, *cells['fw'])
+        ### backward direction runs over the reversed (real) words
+        out_bw, last_bw = lstm(reverse_sequence(embed, lengths), lengths, *cells['bw'])
+        out_bw = reverse_sequence(out_bw, lengths)
+        return np.concatenate([out_fw, out_bw], axis=2), np.concatenate([last_fw, last_bw], axis=1)
+
+    def run(self, names, input_src, input_tgt, len_src, len_tgt):
+        """dict with the outputs names (see inference.output_names) of a batch"""
+        out_src, last_src = self.bilstm(self.LT_src, self.lstm_src, input_src, len_src)
+        out_tgt, last_tgt = self.bilstm(self.LT_tgt, self.lstm_tgt, input_tgt, len_tgt)
+        out = {}
+        if self.config.mode == "sentence":
+            hidden = np.concatenate([last_src * last_tgt, np.abs(last_src - last_tgt)], axis=1)
+            hidden = np.tanh(np.dot(hidden, self.dense[0][0]) + self.dense[0][1])
+            out['sim'] = (np.dot(hidden, self.dense[1][0]) + self.dense[1][1]).reshape(-1)
+        else:
+            out['sim'] = np.sum(l2_normalize(last_src) * l2_normalize(last_tgt), axis=1)
+        if self.cascade is not None and any(name in names for name in stage2_names):
+            ### the second stage only runs over the encoder outputs of some pairs
+            low, high = self.cascade
+
+            def run_stage2(rows):
+                return self.align(names, out_src[rows], out_tgt[rows], len_src[rows], len_tgt[rows])
+
+            out = cascade(out, names, len_src, len_tgt, low, high, run_stage2)
+        else:
+            out.update(self.align(names, out_src, out_tgt, len_src, len_tgt))
+        if 'last_src' in names:
+            out['last_src'] = last_src
+            out['last_tgt'] = last_tgt
+        return out
+
+    def align(self, names, out_src, out_tgt, len_src, len_tgt):
+        """alignment outputs (align, aggr_src, aggr_tgt) in names"""
+        out = {}
+        if 'align' in names or 'aggr_src' in names:
+            align = np.matmul(out_src, out_tgt.transpose(0, 2, 1))
+            out['align'] = align
+        if 'aggr_src' in names:
+            ### src words aggregate over real tgt words, tgt words over real src words
+            mask_src = (np.arange(align.shape[1]) < len_src[:, None])[:, :, None]
+            mask_tgt = (np.arange(align.shape[2]) < len_tgt[:, None])[:, None, :]
+            if self.config.aggr == "lse":
+                R = self.config.r
+                out['aggr_src'] = masked_logsumexp(align * R, mask_tgt, axis=2) / R
+                out['aggr_tgt'] = masked_logsumexp(align * R, mask_src, axis=1) / R
+            elif self.config.aggr == "sum":
+                out['aggr_src'] = np.sum(align * mask_tgt, axis=2)
+                out['aggr_tgt'] = np.sum(align * mask_src, axis=1)
+            else:
+                out['aggr_src'] = masked_max(align, mask_tgt, axis=2)
+                out['aggr_tgt'] = masked_max(align, mask_src, axis=1)
+        return out
+
+    def inference(self, tst, output, quiet=False):
+        names = output_names(self.config, tst.annotated, quiet)
+
+        def run(batch, monitor):
+            src_batch, tgt_batch = batch[0], batch[1]
+            len_src_batch, len_tgt_batch = batch[7], batch[8]
+            return self.run(names, src_batch, tgt_batch, len_src_batch, len_tgt_batch)
+
+        inference(self.config, tst, output, run, self.stats, quiet)
+
+    def encode(self, sents, output):
+        """last vectors of sents (only the encoder of -side is run)"""
+        if self.config.side == "src":
+            LT, cells = self.LT_src, self.lstm_src
+        else:
+            LT, cells = self.LT_tgt, self.lstm_tgt
+
+        def run(input_batch, len_batch):
+            return self.bilstm(LT, cells, input_batch, len_batch)[1]
+
+        encode(self.config, sents, output, run, self.stats)
+
+    def serve(self):
+        """similarity scores of pairs sent to -serve"""
+
+        def run(input_src, input_tgt, len_src, len_tgt):
+            return self.run(['sim'], input_src, input_tgt, len_src, len_tgt)['sim']
+
+        serve(self.config, run, self.stats)
+
+    def close(self):
+        if self.stats is not None:
+            self.stats.close()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from dataset import Dataset
+from np_model import NumpyModel
+from config import Config
+from inference import sentences
+
+
+def main(args):
+    config = Config(args)
+    if config.trn or not (config.tst or config.encode or config.serve):
+        sys.stderr.write("error: np_similarity.py only runs inference (use -tst, -encode or -serve, learning "
+                         "needs similarity.py)\n")
+        sys.exit(1)
+    if config.tst:
+        tst = Dataset(config.tst, config.voc_src, config.tok_src, config.voc_tgt, config.tok_tgt,
+                      seq_size=0, max_sents=0, do_shuffle=False, do_skip_empty=False,
+                      stream=config.shuffle_buffer > 0, tok_workers=config.tok_workers, cache=config.cache)
+    if config.encode:
+        sents = sentences(config)
+    model = NumpyModel(config)
+    if config.tst:
+        model.inference(tst, config.output, quiet=config.quiet)
+        tst.close()
+    if config.encode:
+        model.encode(sents, config.output)
+    if config.serve:
+        model.serve()
+    model.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import tensorflow as tf
+from collections import defaultdict
+from tensorflow.python.client import timeline
+from monitor import parse_steps
+
+
+def op_scope(node):
+    ### top name scope (backward ops are further split by the scope of their forward op)
+    parts = node.node_name.split(':')[0].split('/')
+    if parts[0] == 'gradients' and len(parts) > 2:
+        return '/'.join(parts[:2])
+    return parts[0]
+
+
+def op_type(node):
+    ### timeline labels are like: name = Type(input, ...)
+    if ' = ' in node.timeline_label:
+        return node.timeline_label.split(' = ', 1)[1].split('(', 1)[0]
+    return node.node_name
+
+
+class Profiler():
+    """captures the RunMetadata of training steps first..last (counted from 1 over the whole learning). A chrome trace
+    is written per step (dir/timeline.stepN.json, open it in chrome://tracing) and the cost of ops of all captured
+    steps is summarized by scope and op type (dir/profile.txt)"""
+
+    def __init__(self, steps, dir):
+        self.first, self.last = parse_steps(steps)
+        self.dir = dir
+        self.nsteps = 0
+        ### [microseconds, count]
+        self.by_scope = defaultdict(lambda: [0, 0])
+        self.by_type = defaultdict(lambda: [0, 0])
+
+    def run_args(self, step):
+        """extra arguments of sess.run (none out of the profiled steps)"""
+        if step < self.first or step > self.last:
+            return {}
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), 'run_metadata': tf.RunMetadata()}
+
+    def collect(self, step, run_metadata):
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+        with open('{}/timeline.step{}.json'.format(self.dir, step), 'w') as f:
+            f.write(trace)
+        self.nsteps += 1
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node in dev_stats.node_stats:
+                micros = node.all_end_rel_micros
+                for stats, key in [(self.by_scope, op_scope(node)), (self.by_type, op_type(node))]:
+                    stats[key][0] += micros
+                    stats[key][1] += 1
+        self.write_summary()
+        if step == self.last:
+            sys.stderr.write('Profiled steps {}:{} in {}/profile.txt\n'.format(self.first, self.last, self.dir))
+
+    def write_summary(self):
+        total = max(sum(micros for micros, _ in self.by_type.values()), 1)
+        with open(self.dir + '/profile.txt', 'w') as f:
+            f.write('steps {}:{} ({} captured) total op time {:.2f} ms (summed over devices/threads)\n'.format(
+                self.first, self.last, self.nsteps, total / 1000.0))
+            for title, stats in [('scope', self.by_scope), ('op type', self.by_type)]:
+                f.write('\n{:<40} {:>12} {:>7} {:>8}\n'.format(title, 'ms/step', '%', 'count'))
+                for key, (micros, count) in sorted(stats.items(), key=lambda item: -item[1][0]):
+                    f.write('{:<40} {:>12.3f} {:>7.2f} {:>8}\n'.format(
+                        key, micros / 1000.0 / self.nsteps, 100.0 * micros / total, count))
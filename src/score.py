@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import six
+import threading
+import numpy as np
+from six.moves import queue
+
+
+class Score():
+    def __init__(self):
+        self.TP = 0
+        self.TN = 0
+        self.FP = 0
+        self.FN = 0
+        self.A = 0.0
+        self.P = 0.0
+        self.R = 0.0
+        self.F = 0.0
+
+    def add(self, p, r):
+        ### prediction, reference
+        # when r < 0 => positive example, alignment exists (parallel sentence)
+        # when p > 0 => alignment exists in matrix (similarity is high)
+        if p*r <= 0:
+            if p >= 0:
+                # alignment predicted
+                self.TP += 1
+            else:
+                # alignment not predicted
+                self.TN += 1
+        else:
+            if p >= 0:
+                self.FP += 1
+            else:
+                self.FN += 1
+        # print("Pred:{} Ref:{}, TP:{} TN:{} FP:{} FN:{}".format(p, r, self.TP, self.TN, self.FP, self.FN))
+
+    def add_batch_tokens(self, p, r, l):
+        self.add_counts(batch_counts(p, r, l))
+
+    def add_batch(self, p, r):
+        self.add_counts(batch_counts(p, r))
+
+    def add_counts(self, counts):
+        TP, TN, FP, FN = counts
+        self.TP += TP
+        self.TN += TN
+        self.FP += FP
+        self.FN += FN
+
+    def update(self):
+        self.A, self.P, self.R, self.F = 0.0, 0.0, 0.0, 0.0
+        if (self.TP + self.FP) > 0:
+            # true positives out of all that were predicted positive
+            self.P = 1. * self.TP / (self.TP + self.FP)
+        if (self.TP + self.FN) > 0:
+            # true positives out of all that were actually positive
+            self.R = 1. * self.TP / (self.TP + self.FN)
+        if (self.P + self.R) > 0.0:
+            self.F = 2. * self.P * self.R / (self.P + self.R)
+        if (self.TP + self.TN + self.FP + self.FN) > 0:
+            self.A = 1.0 * (self.TP + self.TN) / (self.TP + self.TN + self.FP + self.FN)
+
+
+def batch_counts(p, r, l=None):
+    """TP, TN, FP, FN counts of a batch (same decisions than Score.add), p and r are padded arrays of predictions
+    and references, words of sentence s are p[s][:l[s]]"""
+    p = np.asarray(p)
+    r = np.asarray(r)
+    if l is not None:
+        mask = np.arange(p.shape[1]) < np.asarray(l)[:, None]
+        p = p[mask]
+        r = r[mask]
+    agree = p * r <= 0
+    positive = p >= 0
+    TP = int(np.count_nonzero(agree & positive))
+    TN = int(np.count_nonzero(agree)) - TP
+    FP = int(np.count_nonzero(positive)) - TP
+    FN = p.size - TP - TN - FP
+    return TP, TN, FP, FN
+
+
+class Scorer():
+    """adds batch counts to scores, in a side thread (bounded queue of batches) if run_async"""
+
+    def __init__(self, run_async=False, depth=4):
+        self.run_async = run_async
+        self.error = None
+        if self.run_async:
+            self.queue = queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self, scores, p, r, l=None):
+        if not self.run_async:
+            self.add_counts(scores, p, r, l)
+            return
+        self.check()
+        ### references may live in reused batch buffers, they are copied
+        self.queue.put((scores, p, np.array(r), None if l is None else np.array(l)))
+
+    def add_counts(self, scores, p, r, l):
+        counts = batch_counts(p, r, l)
+        for score in scores:
+            score.add_counts(counts)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    self.add_counts(*job)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        ### returns once all queued batches are added
+        if self.run_async:
+            self.queue.join()
+            self.check()
+
+    def check(self):
+        if self.error is not None:
+            six.reraise(*self.error)
+
+    def close(self):
+        if self.run_async:
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+import numpy as np
+from collections import deque
+from itertools import chain
+from six.moves import queue, socketserver, BaseHTTPServer
+from dataset import idx_pad, split_chunk
+from tokenizer import PairTokenizer
+
+
+def parse_address(address):
+    """HOST:PORT or unix:PATH => (host, port) or path"""
+    if address.startswith('unix:'):
+        return address[5:]
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        return None
+    return host or 'localhost', int(port)
+
+
+def percentiles(values):
+    """p50, p90, p99 and max of values in milliseconds"""
+    if len(values) == 0:
+        return {'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+    p50, p90, p99, pmax = np.percentile(np.array(values) * 1000.0, [50, 90, 99, 100])
+    return {'p50': round(p50, 2), 'p90': round(p90, 2), 'p99': round(p99, 2), 'max': round(pmax, 2)}
+
+
+class Request():
+    """pairs of a client request (ids of src/tgt words), scores are set by the batcher thread. arrival is the time the
+    request was received (before parsing and tokenization), queued the time it was ready to be batched"""
+
+    def __init__(self, isrc, itgt, arrival):
+        self.isrc = isrc
+        self.itgt = itgt
+        self.max_src = max([len(s) for s in isrc] + [1])
+        self.max_tgt = max([len(t) for t in itgt] + [1])
+        self.arrival = arrival
+        self.queued = time.time()
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ServerStats():
+    """counters since the server started, latencies (arrival to scores) and batching waits (queued to run) of the
+    last window requests"""
+
+    def __init__(self, window=10000):
+        self.ini = time.time()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.waits = deque(maxlen=window)
+        self.requests = 0
+        self.pairs = 0
+        self.batches = 0
+        self.run_secs = 0.0
+
+    def add_batch(self, requests, start, end):
+        with self.lock:
+            self.batches += 1
+            self.run_secs += end - start
+            for r in requests:
+                self.requests += 1
+                self.pairs += len(r.isrc)
+                self.waits.append(start - r.queued)
+                self.latencies.append(end - r.arrival)
+
+    def stats(self):
+        with self.lock:
+            elapsed = max(time.time() - self.ini, 1e-6)
+            return {
+                'elapsed': round(elapsed, 3),
+                'requests': self.requests,
+                'pairs': self.pairs,
+                'batches': self.batches,
+                'pairs_per_batch': round(1.0 * self.pairs / max(self.batches, 1), 2),
+                'requests_per_batch': round(1.0 * self.requests / max(self.batches, 1), 2),
+                'pairs_per_sec': round(self.pairs / elapsed, 2),
+                'run_secs': round(self.run_secs, 3),
+                'latency_ms': percentiles(list(self.latencies)),
+                'wait_ms': percentiles(list(self.waits))}
+
+
+class Batcher():
+    """coalesces the requests of concurrent clients into batches run by a single thread: a batch is run when its
+    first request has waited max_wait seconds, or when it is full (batch_size pairs, or batch_tokens padded cells
+    B*(S+T) when batch_tokens > 0). A request larger than a full batch is run alone"""
+
+    def __init__(self, config, run, max_wait):
+        self.config = config
+        self.run = run
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.stats = ServerStats()
+        ### built once (not per connection thread), tokenization is serialized by a lock
+        self.tokenizer = None
+        if config.tok_src or config.tok_tgt:
+            self.tokenizer = PairTokenizer(config.tok_src, config.tok_tgt)
+        self.tokenizer_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def encode(self, entries):
+        """tokenized (as -tst entries) and vocab-mapped src/tgt words of entries (lists of columns)"""
+        if self.tokenizer is not None:
+            with self.tokenizer_lock:
+                entries = self.tokenizer.tokenize(entries)
+        src = [e[0].split(' ')[:500] for e in entries]
+        tgt = [e[1].split(' ')[:500] for e in entries]
+        isrc = split_chunk(self.config.voc_src.encode(list(chain.from_iterable(src))), src)
+        itgt = split_chunk(self.config.voc_tgt.encode(list(chain.from_iterable(tgt))), tgt)
+        return isrc, itgt
+
+    def score(self, entries, arrival):
+        """scores of entries (blocks the client thread until its batch is run)"""
+        isrc, itgt = self.encode(entries)
+        request = Request(isrc, itgt, arrival)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def full(self, npairs, max_src, max_tgt):
+        if self.config.batch_tokens > 0:
+            return npairs * (max_src + max_tgt) >= self.config.batch_tokens
+        return npairs >= self.config.batch_size
+
+    def fits(self, npairs, max_src, max_tgt):
+        if self.config.batch_tokens > 0:
+            return npairs * (max_src + max_tgt) <= self.config.batch_tokens
+        return npairs <= self.config.batch_size
+
+    def loop(self):
+        pending = None
+        while True:
+            first = pending if pending is not None else self.queue.get()
+            pending = None
+            if first is None:
+                ### stopped by close()
+                return
+            batch = [first]
+            npairs, max_src, max_tgt = len(first.isrc), first.max_src, first.max_tgt
+            deadline = first.queued + self.max_wait
+            while not self.full(npairs, max_src, max_tgt):
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    ### the batch is run before stopping
+                    self.queue.put(None)
+                    break
+                if not self.fits(npairs + len(request.isrc), max(max_src, request.max_src),
+                                 max(max_tgt, request.max_tgt)):
+                    ### starts the next batch
+                    pending = request
+                    break
+                batch.append(request)
+                npairs += len(request.isrc)
+                max_src = max(max_src, request.max_src)
+                max_tgt = max(max_tgt, request.max_tgt)
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        start = time.time()
+        try:
+            isrc = list(chain.from_iterable(r.isrc for r in batch))
+            itgt = list(chain.from_iterable(r.itgt for r in batch))
+            input_src, len_src = padded(isrc)
+            input_tgt, len_tgt = padded(itgt)
+            scores = self.run(input_src, input_tgt, len_src, len_tgt)
+            ini = 0
+            for r in batch:
+                r.scores = scores[ini:ini+len(r.isrc)]
+                ini += len(r.isrc)
+        except Exception as e:
+            for r in batch:
+                r.error = e
+        end = time.time()
+        self.stats.add_batch(batch, start, end)
+        for r in batch:
+            r.done.set()
+
+
+def padded(seqs):
+    """padded array (idx_pad) of sequences of ids and their lengths"""
+    lens = np.array([len(s) for s in seqs], dtype=np.int32)
+    input = np.full((len(seqs), max(int(lens.max()), 1)), idx_pad, dtype=np.int32)
+    input[np.arange(input.shape[1]) < lens[:, None]] = np.fromiter(chain.from_iterable(seqs), dtype=np.int32,
+                                                                   count=int(lens.sum()))
+    return input, lens
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """POST /score: a pair per line (src tab tgt), answers a score per line. GET /stats: json stats"""
+    protocol_version = 'HTTP/1.1'
+    ### responses are buffered (flushed by handle_one_request): unbuffered header/body writes are separate tcp
+    ### segments, delayed by nagle and delayed acks on keep-alive connections
+    wbufsize = -1
+
+    def do_POST(self):
+        arrival = time.time()
+        if self.path != '/score':
+            return self.reply(404, 'error: unknown path {}\n'.format(self.path))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        entries = [line.strip().split('\t') for line in body.splitlines()]
+        if len(entries) == 0:
+            return self.reply(200, '')
+        if any(len(e) < 2 for e in entries):
+            return self.reply(400, 'error: every line must contain src tab tgt\n')
+        try:
+            scores = self.server.batcher.score([e[:2] for e in entries], arrival)
+        except Exception as e:
+            return self.reply(500, 'error: {}\n'.format(e))
+        self.reply(200, ''.join('{:.4f}\n'.format(s) for s in scores))
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, 'error: unknown path {}\n'.format(self.path))
+        self.reply(200, json.dumps(self.server.batcher.stats.stats(), sort_keys=True) + '\n', 'application/json')
+
+    def reply(self, code, body, ctype='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        ### clients of unix sockets have no address
+        return str(self.client_address)
+
+    def log_message(self, format, *args):
+        return
+
+
+class TCPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(config, run, stats=None):
+    """serves scores of pairs over http (config.serve is HOST:PORT or unix:PATH) until interrupted, run(input_src,
+    input_tgt, len_src, len_tgt) returns the similarity scores of a batch"""
+    address = parse_address(config.serve)
+    if isinstance(address, tuple):
+        server = TCPServer(address, Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixServer(address, Handler)
+    server.batcher = Batcher(config, run, config.max_wait_ms / 1000.0)
+    sys.stderr.write('Serving on {} (max_wait_ms={} {})\n'.format(
+        config.serve, config.max_wait_ms, 'batch_tokens={}'.format(config.batch_tokens) if config.batch_tokens > 0
+        else 'batch_size={}'.format(config.batch_size)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    server.batcher.close()
+    if not isinstance(address, tuple):
+        os.remove(address)
+    s = server.batcher.stats.stats()
+    sys.stderr.write(
+        'SERVE requests={} pairs={} batches={} pairs/batch={:.2f} pairs/s={:.1f} latency(ms): p50={:.2f} p90={:.2f} '
+        'p99={:.2f} max={:.2f}\n'.format(
+            s['requests'], s['pairs'], s['batches'], s['pairs_per_batch'], s['pairs_per_sec'], s['latency_ms']['p50'],
+            s['latency_ms']['p90'], s['latency_ms']['p99'], s['latency_ms']['max']))
+    if stats is not None:
+        s.update({'time': round(time.time(), 3), 'phase': 'serve'})
+        stats.write(json.dumps(s, sort_keys=True) + '\n')
+        stats.flush()
@@ -6,6 +6,7 @@ import sys
 from dataset import Dataset, Vocab
 from model import Model
 from config import Config
+from inference import sentences
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 tf.logging.set_verbosity(tf.logging.ERROR)
@@ -13,22 +14,41 @@ tf.logging.set_verbosity(tf.logging.ERROR)
 
 def main(args):
     config = Config(args)
+    ### data sets are read before the session (and its threads) exist: tokenizer worker processes are forked here
+    stream = config.shuffle_buffer > 0
+    datasets = []
+    if config.trn:
+        trn = Dataset(config.trn, config.voc_src, config.tok_src, config.voc_tgt, config.tok_tgt,
+                      config.seq_size, config.max_sents, do_shuffle=True, do_skip_empty=True,
+                      stream=stream, shuffle_buffer=config.shuffle_buffer, tok_workers=config.tok_workers,
+                      cache=config.cache, encode_once=config.encode_once)
+        dev = Dataset(config.dev, config.voc_src, config.tok_src, config.voc_tgt, config.tok_tgt,
+                      seq_size=0, max_sents=0, do_shuffle=False, do_skip_empty=True, stream=stream,
+                      tok_workers=config.tok_workers, cache=config.cache, encode_once=config.encode_once)
+        datasets += [trn, dev]
+    if config.tst:
+        tst = Dataset(config.tst, config.voc_src, config.tok_src, config.voc_tgt, config.tok_tgt,
+                      seq_size=0, max_sents=0, do_shuffle=False, do_skip_empty=False, stream=stream,
+                      tok_workers=config.tok_workers, cache=config.cache)
+        datasets.append(tst)
+    if config.encode:
+        sents = sentences(config)
+
     model = Model(config)
     model.build_graph()
     model.initialize_session()
-
     if config.trn:
-        trn = Dataset(config.trn, config.voc_src, config.tok_src, config.voc_tgt, config.tok_tgt,
-                      config.seq_size, config.max_sents, do_shuffle=True, do_skip_empty=True)
-        dev = Dataset(config.dev, config.voc_src, config.tok_src, config.voc_tgt, config.tok_tgt,
-                      seq_size=0, max_sents=0, do_shuffle=False, do_skip_empty=True)
         model.learn(trn, dev, config.n_epochs)
     if config.tst:
-        tst = Dataset(config.tst, config.voc_src, config.tok_src, config.voc_tgt, config.tok_tgt,
-                      seq_size=0, max_sents=0, do_shuffle=False, do_skip_empty=False)
         model.inference(tst, config.output, quiet=config.quiet)
+    if config.encode:
+        model.encode(sents, config.output)
+    if config.serve:
+        model.serve()
 
     model.close_session()
+    for data in datasets:
+        data.close()
 
 
 if __name__ == "__main__":
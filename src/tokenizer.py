@@ -2,6 +2,7 @@
 
 import os
 import six
+import multiprocessing
 
 
 def build_tokenizer(args):
@@ -17,3 +18,51 @@ def build_tokenizer(args):
     del local_args['mode']
     del local_args['vocabulary']
     return pyonmttok.Tokenizer(mode, **local_args)
+
+
+def build_tokenizers(tok_src, tok_tgt):
+    """Builds src and tgt tokenizers (None when options are not given)."""
+    return [build_tokenizer(tok_src) if tok_src else None, build_tokenizer(tok_tgt) if tok_tgt else None]
+
+
+def tokenize_columns(tokenizers, lsplit):
+    """Tokenizes src (first) and tgt (second) columns of lsplit."""
+    for i in range(2):
+        if tokenizers[i] is not None:
+            tokens, _ = tokenizers[i].tokenize(str(lsplit[i]))
+            lsplit[i] = " ".join(tokens)
+    return lsplit
+
+
+### tokenizers of pool worker processes
+_worker_tokenizers = []
+
+
+def init_worker(tok_src, tok_tgt):
+    _worker_tokenizers[:] = build_tokenizers(tok_src, tok_tgt)
+
+
+def tokenize_entry(lsplit):
+    return tokenize_columns(_worker_tokenizers, lsplit)
+
+
+class PairTokenizer():
+    """Tokenizes blocks of entries, sharded over a pool of workers processes if workers > 1 (order is kept)."""
+
+    def __init__(self, tok_src, tok_tgt, workers=1):
+        self.pool = None
+        self.tokenizers = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(tok_src, tok_tgt))
+        else:
+            self.tokenizers = build_tokenizers(tok_src, tok_tgt)
+
+    def tokenize(self, entries):
+        if self.pool is None:
+            return [tokenize_columns(self.tokenizers, lsplit) for lsplit in entries]
+        return self.pool.map(tokenize_entry, entries, chunksize=64)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -1,13 +1,11 @@
 # -*- coding: utf-8 -*-
 
-import tensorflow as tf
 import numpy as np
 import math
 import sys
 import os
 import time
 from random import randint
-from config import Config
 from dataset import minibatches
 
 
@@ -0,0 +1,55 @@
+#!/usr/bin/python -u
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+
+
+def main(args):
+    """prints the learning curves (one line per epoch) from the json metrics written while learning
+    (mdir/metrics.jsonl), use -reports to print also the intermediate reports"""
+    reports = False
+    files = []
+    for arg in args[1:]:
+        if arg == '-reports':
+            reports = True
+        else:
+            files.append(arg)
+
+    train = {}
+    valid = {}
+    lines = []
+    for file in files or ['-']:
+        f = sys.stdin if file == '-' else open(file)
+        for line in f:
+            rec = json.loads(line)
+            if rec.get('kind') == 'epoch' and rec['phase'] == 'train':
+                train[rec['epoch']] = rec
+            elif rec.get('kind') == 'epoch' and rec['phase'] == 'valid':
+                valid[rec['epoch']] = rec
+            elif rec.get('kind') == 'report' and reports:
+                lines.append(rec)
+        if f is not sys.stdin:
+            f.close()
+
+    if reports:
+        print("Epoch\tIter\tloss\tF\tLR\tstep(s)\tpairs/s")
+        for rec in lines:
+            print("{}\t{}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.1f}".format(
+                rec['epoch'], rec['iter'], rec['loss'], rec['F'], rec['lr'], rec['window']['step_time'],
+                rec['window']['pairs_per_sec']))
+        print("")
+
+    print("Epoch\tT____F\tT__loss\tV____F\tV__loss\tLR\tT_secs")
+    for epoch in sorted(train):
+        t = train[epoch]
+        vF, vloss = '', ''
+        if epoch in valid:
+            vF = "{:.4f}".format(valid[epoch]['F'])
+            vloss = "{:.4f}".format(valid[epoch]['loss'])
+        print("{}\t{:.4f}\t{:.4f}\t{}\t{}\t{:.4f}\t{:.1f}".format(
+            epoch, t['F'], t['loss'], vF, vloss, t['lr'], t['total']['elapsed']))
+
+
+if __name__ == "__main__":
+    main(sys.argv)